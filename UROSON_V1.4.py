@@ -1,6 +1,6 @@
 import customtkinter as ctk
 import tkinter as tk
-from tkinter import messagebox, ttk
+from tkinter import messagebox, ttk, filedialog
 import sys
 import os
 import threading
@@ -8,23 +8,69 @@ import time
 import queue
 from PIL import Image
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.figure import Figure
 import sqlite3
 from tkcalendar import DateEntry
 import datetime
 from fpdf import FPDF
-import csv
+import re
+import collections
+import contextlib
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import multiprocessing
+import io
+import zlib
+import numpy as np
 
 try:
     import serial
+    from serial.tools import list_ports
+    SerialException = serial.SerialException
 except ImportError:
     serial = None
+    list_ports = None
+    SerialException = OSError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 ctk.set_appearance_mode("light")
 ctk.set_default_color_theme("blue")
 
-COM_PORT = "COM3"
-BAUDRATE = 9600
+COM_PORT = "COM3"  # tried first; other ports are found by discovery
+BAUDRATE = 115200
+BAUDRATES = (115200, 9600)  # v4/v5 firmware, older v2 sketches
+SERIAL_PROTOCOL = "binary"  # "binary" frames (New_RAW_Calibration_v5, falls back to text lines) or "ascii" lines only
+BINARY_REQUESTS = 3  # unanswered requests for binary frames before falling back to text (pre-v5 boards)
+SAMPLE_PERIOD_S = 0.05  # firmware update interval, used when samples carry no device time
+MILLIS_WRAP = 1 << 32
+CLOCK_DRIFT_BASELINE_S = 10.0  # device/host span needed before drift is estimated
+SERIAL_READ_TIMEOUT_S = 0.05  # bounds how long a queued command waits for the reader
+COMMAND_TIMEOUT_S = 3.0
+TEXT_LINE_LIMIT = 256  # bytes of unterminated text kept between binary frames
+PROBE_S = 2.5  # covers the bootloader delay after the open resets the board
+RECONNECT_MIN_S = 0.5
+RECONNECT_MAX_S = 8.0
+FIRMWARE_BANNER = b"LOADCELL"
+DATA_LINE_RE = re.compile(rb"(?m)^-?\d+\.\d+,-?\d+\.\d+(,\d+)?\r?$")
+FilterConfig = collections.namedtuple(
+    "FilterConfig", "source median differentiator window order cutoff_hz raw_offset raw_scale calibration")
+# source: "device" keeps the firmware's flow, "weight" or "raw" (load cell counts,
+# binary frames only) derive flow on the host; median: samples in the spike
+# rejecting median, 1 to skip; differentiator: "savgol" over window samples with
+# a polynomial of order, or "butterworth" low-pass at cutoff_hz; raw counts are
+# turned into grams relative to the tare counts raw_offset (None: the host's
+# tare, see HostFilter) by a calibration profile, (center, coefficients), or else
+# divided by raw_scale
+HOST_FILTER = FilterConfig("weight", 5, "savgol", 11, 2, 2.0, 0.0, 1.0, None)
+FILTER_MAX_TAPS = 1024  # Butterworth impulse responses are truncated to FIR at this length...
+FILTER_IMPULSE_TOL = 1e-6  # ...or once they decay below this fraction of their peak
 
 sidebar_bg_color = "#D4EBF8"
 BTN_WIDTH = 160
@@ -33,9 +79,114 @@ BTN_FONT = ("Arial", 16, "bold")
 BTN_ANCHOR = "w"
 BTN_SPACING = 12
 
-def setup_database():
-    conn = sqlite3.connect('hospital_doctor.db')
-    c = conn.cursor()
+PLOT_WINDOW_S = 60
+MAX_SAMPLE_RATE = 200  # Hz, sizes the live window buffer
+WINDOW_CAPACITY = PLOT_WINDOW_S * MAX_SAMPLE_RATE
+RECORDER_CHUNK = 4096  # samples per session recorder chunk
+
+RECORDING_CHUNK = 4096  # samples per chunk index entry in a stored recording
+PYRAMID_BIN = 16  # samples per bin at the finest min/max pyramid level
+PYRAMID_FANOUT = 4  # bins merged into one at each coarser level
+RECORDING_FILE_MIN_SAMPLES = 1 << 18  # longer recordings are stored as mapped files
+RECORDINGS_DIR = 'recordings'
+FLOW_THRESHOLD = 1.0  # ml/s, flow at or above this counts as voiding
+FLOW_MERGE_GAP_S = 0.5  # dips below threshold shorter than this do not split a void
+FLOW_MIN_SEGMENT_S = 0.5  # shorter bursts of flow are dribble or artefact
+QMAX_MEDIAN_S = 1.0  # running median that rejects spikes before taking Qmax
+PLATEAU_LEVEL = 0.75  # plateau pattern: flow stays above this fraction of Qmax...
+PLATEAU_FRACTION = 0.5  # ...for at least this fraction of the flow time
+STACCATO_SWING = 0.25  # staccato pattern: rises and falls above this fraction of Qmax
+METRICS_VERSION = 2  # bump when analyze_uroflow changes its results
+REANALYSIS_CACHE_SIZE = 16  # re-analysed recordings kept in memory for the Report window
+CALIBRATION_CAPTURE_SAMPLES = 40  # raw readings per reference weight, reduced to their median
+CALIBRATION_CAPTURE_TIMEOUT_S = 10.0  # a capture that has not collected its readings by then is abandoned
+CALIBRATION_DEGREES = {"Linear": 1, "Quadratic": 2, "Cubic": 3}
+AUTO_STOP_NO_FLOW_S = 10.0  # end a test once flow has stopped this long; None to disable
+RENDER_FPS = 20  # target frame rate of the live plot
+X_TICK_STEP = 10  # s, the live x-axis scrolls one tick step at a time
+
+DB_PATH = 'hospital_doctor.db'
+REPORT_PAGE_SIZE = 100  # patients fetched per page in the Report list
+REPORT_MAX_PAGES = 5  # pages held in the Report list at once
+REPORT_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))  # PDF builder processes
+REPORT_JOB_SLOTS = 256  # cancellation flags shared with the workers, reused round robin
+REPORT_POLL_MS = 50
+REPORT_DPI = 150
+REPORT_BATCH_CHUNK = 8  # patients per worker task in a batch export
+REPORT_TEMPLATE_VERSION = 3  # bump when the report layout or plot changes
+REPORT_CACHE_DIR = 'report_cache'
+REPORT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+REPORT_CACHE_MAX_ENTRIES = 2000
+DB_STATEMENT_CACHE = 256
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",  # WAL keeps this durable across app crashes
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",  # KiB
+    "PRAGMA busy_timeout=5000",
+)
+
+class Database:
+    # Persistent SQLite access. Each thread (the Tk thread, report workers)
+    # gets one long-lived connection, opened on first use with WAL and the
+    # pragmas above; sqlite3's per-connection statement cache then reuses
+    # prepared statements. Connections run in autocommit mode and writes
+    # that belong together go through transaction().
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                   cached_statements=DB_STATEMENT_CACHE)
+            for pragma in DB_PRAGMAS:
+                conn.execute(pragma)
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def query(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        return self.connection().execute(sql, params).fetchone()
+
+    def execute(self, sql, params=()):
+        with self.transaction() as conn:
+            return conn.execute(sql, params)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.connection()
+        if conn.in_transaction:
+            # Nested use joins the outer transaction
+            yield conn
+            return
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
+db = Database(DB_PATH)
+
+def migrate_base_schema(c):
+    # Schema as created by UROSON <= 1.4, including its ad-hoc column upgrades
     c.execute('''
         CREATE TABLE IF NOT EXISTS hospitals (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -63,44 +214,2130 @@ def setup_database():
             doctor_name TEXT
         )
     ''')
-    try:
+    columns = {row[1] for row in c.execute("PRAGMA table_info(patients)")}
+    if "hospital_name" not in columns:
         c.execute("ALTER TABLE patients ADD COLUMN hospital_name TEXT")
-    except sqlite3.OperationalError:
-        pass
-    try:
+    if "doctor_name" not in columns:
         c.execute("ALTER TABLE patients ADD COLUMN doctor_name TEXT")
-    except sqlite3.OperationalError:
-        pass
-    conn.commit()
-    conn.close()
+
+def migrate_lookup_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_patients_patient_id ON patients(patient_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_patients_date ON patients(date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_hospitals_name ON hospitals(name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_doctors_name ON doctors(name)")
+
+def migrate_foreign_keys(c):
+    # Patients reference hospitals/doctors by id instead of by free-text name.
+    # Deleting a hospital or doctor only deactivates it, so old reports keep
+    # their names; names with no matching row come back as inactive rows.
+    c.execute("ALTER TABLE hospitals ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+    c.execute("ALTER TABLE doctors ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+    c.execute("""
+        INSERT INTO hospitals (name, address, active)
+        SELECT DISTINCT hospital_name, '', 0 FROM patients
+        WHERE hospital_name != '' AND hospital_name NOT IN (SELECT name FROM hospitals)
+    """)
+    c.execute("""
+        INSERT INTO doctors (name, active)
+        SELECT DISTINCT doctor_name, 0 FROM patients
+        WHERE doctor_name != '' AND doctor_name NOT IN (SELECT name FROM doctors)
+    """)
+    c.execute("""
+        CREATE TABLE patients_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            gender TEXT,
+            age INTEGER,
+            date TEXT,
+            time TEXT,
+            hospital_id INTEGER REFERENCES hospitals(id),
+            doctor_id INTEGER REFERENCES doctors(id)
+        )
+    """)
+    c.execute("""
+        INSERT INTO patients_new (id, patient_id, first_name, last_name, gender, age, date, time, hospital_id, doctor_id)
+        SELECT p.id, p.patient_id, p.first_name, p.last_name, p.gender, p.age, p.date, p.time,
+               (SELECT MIN(h.id) FROM hospitals h WHERE h.name = p.hospital_name),
+               (SELECT MIN(d.id) FROM doctors d WHERE d.name = p.doctor_name)
+        FROM patients p
+    """)
+    c.execute("DROP TABLE patients")
+    c.execute("ALTER TABLE patients_new RENAME TO patients")
+    c.execute("CREATE INDEX idx_patients_patient_id ON patients(patient_id)")
+    c.execute("CREATE INDEX idx_patients_date ON patients(date)")
+    c.execute("CREATE INDEX idx_patients_hospital_id ON patients(hospital_id)")
+    c.execute("CREATE INDEX idx_patients_doctor_id ON patients(doctor_id)")
+
+def migrate_recordings(c):
+    # Waveforms live in the database, keyed by the patients row, instead of
+    # {pid}_{first}_{last}_data.csv files in the working directory. Existing
+    # CSV files are imported (and left in place).
+    c.execute("""
+        CREATE TABLE recordings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_row_id INTEGER NOT NULL UNIQUE REFERENCES patients(id) ON DELETE CASCADE,
+            n_samples INTEGER NOT NULL,
+            columns TEXT NOT NULL,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            checksum TEXT NOT NULL
+        )
+    """)
+    patients = c.execute("SELECT id, patient_id, first_name, last_name FROM patients").fetchall()
+    for row_id, pid, first, last in patients:
+        for filename in (f"{pid}_{first}_{last}_data.csv", f"{pid}_data.csv"):
+            if os.path.exists(filename):
+                try:
+                    columns = read_recording_csv(filename)
+                except ValueError:
+                    print(f"Skipping unreadable recording {filename}")
+                    break
+                packed = np.vstack(columns).astype('<f4').tobytes()
+                c.execute("INSERT INTO recordings (patient_row_id, n_samples, columns, codec, data, checksum) VALUES (?, ?, ?, ?, ?, ?)",
+                          (row_id, len(columns[0]), "time,flow,volume", "zlib", zlib.compress(packed, 6),
+                           hashlib.sha256(packed).hexdigest()))
+                break
+
+def migrate_recording_files(c):
+    # Recordings are rewritten in the columnar format (chunk index, min/max
+    # pyramid, raw counts column); long ones move out to mapped files
+    c.execute("ALTER TABLE recordings ADD COLUMN path TEXT")
+    rows = c.execute("SELECT patient_row_id, n_samples, columns, codec, data FROM recordings").fetchall()
+    for row_id, n_samples, columns, codec, blob in rows:
+        packed = decompress_recording(codec, blob)
+        if not packed.startswith(RECORDING_MAGIC):
+            # Shaped by the stored column count: header-only CSVs were imported with no samples
+            n_columns = len(columns.split(","))
+            save_recording(c, row_id, *np.frombuffer(packed, dtype='<f4').reshape(n_columns, n_samples))
+
+def migrate_patient_search(c):
+    # Full-text index over patient, hospital and doctor names, ID and date,
+    # keyed by patients.id and kept in step by triggers. Hospital and doctor
+    # names are copied in, so renaming one updates its patients' entries.
+    c.execute('''
+        CREATE VIRTUAL TABLE patients_fts USING fts5(
+            patient_id, first_name, last_name, date, hospital, doctor,
+            tokenize="unicode61 remove_diacritics 2"
+        )
+    ''')
+    c.execute('''
+        CREATE TRIGGER patients_fts_insert AFTER INSERT ON patients BEGIN
+            INSERT INTO patients_fts (rowid, patient_id, first_name, last_name, date, hospital, doctor)
+            VALUES (new.id, new.patient_id, new.first_name, new.last_name, new.date,
+                    (SELECT name FROM hospitals WHERE id = new.hospital_id),
+                    (SELECT name FROM doctors WHERE id = new.doctor_id));
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER patients_fts_delete AFTER DELETE ON patients BEGIN
+            DELETE FROM patients_fts WHERE rowid = old.id;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER patients_fts_update AFTER UPDATE ON patients BEGIN
+            DELETE FROM patients_fts WHERE rowid = old.id;
+            INSERT INTO patients_fts (rowid, patient_id, first_name, last_name, date, hospital, doctor)
+            VALUES (new.id, new.patient_id, new.first_name, new.last_name, new.date,
+                    (SELECT name FROM hospitals WHERE id = new.hospital_id),
+                    (SELECT name FROM doctors WHERE id = new.doctor_id));
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER hospitals_fts_update AFTER UPDATE OF name ON hospitals BEGIN
+            UPDATE patients_fts SET hospital = new.name
+            WHERE rowid IN (SELECT id FROM patients WHERE hospital_id = new.id);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER doctors_fts_update AFTER UPDATE OF name ON doctors BEGIN
+            UPDATE patients_fts SET doctor = new.name
+            WHERE rowid IN (SELECT id FROM patients WHERE doctor_id = new.id);
+        END
+    ''')
+    c.execute('''
+        INSERT INTO patients_fts (rowid, patient_id, first_name, last_name, date, hospital, doctor)
+        SELECT p.id, p.patient_id, p.first_name, p.last_name, p.date, h.name, d.name
+        FROM patients p LEFT JOIN hospitals h ON h.id = p.hospital_id LEFT JOIN doctors d ON d.id = p.doctor_id
+    ''')
+
+def migrate_report_cache(c):
+    # Built report PDFs (see ReportCache). patient_row_id has no foreign key:
+    # deleting a patient purges its rows together with their files.
+    c.execute('''
+        CREATE TABLE report_cache (
+            key TEXT PRIMARY KEY,
+            patient_row_id INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        )
+    ''')
+    c.execute("CREATE INDEX idx_report_cache_last_used ON report_cache(last_used)")
+    c.execute("CREATE INDEX idx_report_cache_patient ON report_cache(patient_row_id)")
+
+def migrate_recording_metrics(c):
+    # Uroflow metrics, computed once per recording content and analysis
+    # parameters (see analysis_key)
+    c.execute('''
+        CREATE TABLE recording_metrics (
+            key TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        )
+    ''')
+
+def migrate_calibration_profiles(c):
+    # Host-side load cell calibrations, one active per device. The model is
+    # grams = polyval(coefficients, counts - center), fitted to points
+    # ([counts, grams] pairs) with an RMS error of residual grams.
+    c.execute('''
+        CREATE TABLE calibration_profiles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device TEXT NOT NULL,
+            created TEXT NOT NULL,
+            center REAL NOT NULL,
+            coefficients TEXT NOT NULL,
+            points TEXT NOT NULL,
+            residual REAL NOT NULL,
+            active INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    c.execute("CREATE INDEX idx_calibration_profiles_device ON calibration_profiles(device, active)")
+
+# Applied in order; PRAGMA user_version records how many have run
+MIGRATIONS = (
+    migrate_base_schema,
+    migrate_lookup_indexes,
+    migrate_foreign_keys,
+    migrate_recordings,
+    migrate_recording_files,
+    migrate_patient_search,
+    migrate_report_cache,
+    migrate_recording_metrics,
+    migrate_calibration_profiles,
+)
+
+def setup_database():
+    version = db.query_one("PRAGMA user_version")[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with db.transaction() as c:
+            migration(c)
+            c.execute(f"PRAGMA user_version={number}")
+
+RECORDING_COLUMNS = ("time", "flow", "volume", "raw")
+RECORDING_DTYPES = ('<f8', '<f4', '<f4', '<f4')
+RECORDING_MAGIC = b"UROREC01"
+RECORDING_HEADER = np.dtype([('magic', 'S8'), ('n_columns', '<u4'), ('chunk_size', '<u4'), ('n_samples', '<u8'),
+                             ('bin_size', '<u4'), ('fanout', '<u4')])
+
+def recording_layout(n_columns, n_samples, chunk_size, bin_size, fanout):
+    # Byte offsets of each section of a recording; shared by the writer and
+    # RecordingFile. Sections start on 8-byte boundaries:
+    #   header | chunk index | one run per column | pyramid levels
+    # A level holds the start time of each bin and, per value column, the
+    # min and max of the bin; each level merges fanout bins of the one below.
+    def align(pos):
+        return -(-pos // 8) * 8
+
+    index_dtype = np.dtype([('first', '<f8'), ('last', '<f8'), ('sum', '<f8', (n_columns - 1,))])
+    n_chunks = -(-n_samples // chunk_size)
+    index_offset = align(RECORDING_HEADER.itemsize)
+    pos = align(index_offset + n_chunks * index_dtype.itemsize)
+    column_offsets = []
+    for dtype in RECORDING_DTYPES[:n_columns]:
+        column_offsets.append(pos)
+        pos = align(pos + n_samples * np.dtype(dtype).itemsize)
+    levels = []
+    size = bin_size
+    while n_samples:
+        n_bins = -(-n_samples // size)
+        levels.append((pos, n_bins))
+        pos = align(pos + n_bins * 8 + (n_columns - 1) * 2 * n_bins * 4)
+        if n_bins <= fanout:
+            break
+        size *= fanout
+    return index_dtype, n_chunks, index_offset, column_offsets, levels, pos
+
+def pack_recording(columns):
+    # Missing trailing columns (e.g. raw counts from an ASCII stream) are NaN
+    n = len(columns[0])
+    columns = [np.asarray(col, dtype=float) for col in columns]
+    columns += [np.full(n, np.nan)] * (len(RECORDING_COLUMNS) - len(columns))
+    index_dtype, n_chunks, index_offset, column_offsets, levels, size = recording_layout(
+        len(columns), n, RECORDING_CHUNK, PYRAMID_BIN, PYRAMID_FANOUT)
+    buf = bytearray(size)
+    header = np.frombuffer(buf, RECORDING_HEADER, count=1)
+    header[0] = (RECORDING_MAGIC, len(columns), RECORDING_CHUNK, n, PYRAMID_BIN, PYRAMID_FANOUT)
+    if not n:
+        return bytes(buf)
+
+    for col, dtype, offset in zip(columns, RECORDING_DTYPES, column_offsets):
+        np.frombuffer(buf, dtype, count=n, offset=offset)[:] = col
+    times, values = columns[0], np.vstack(columns[1:])
+
+    index = np.frombuffer(buf, index_dtype, count=n_chunks, offset=index_offset)
+    starts = np.arange(0, n, RECORDING_CHUNK)
+    index['first'] = times[starts]
+    index['last'] = times[np.minimum(starts + RECORDING_CHUNK, n) - 1]
+    index['sum'] = np.add.reduceat(values, starts, axis=1).T
+
+    starts = np.arange(0, n, PYRAMID_BIN)
+    bin_times = times[starts]
+    mins = np.minimum.reduceat(values, starts, axis=1)
+    maxs = np.maximum.reduceat(values, starts, axis=1)
+    for offset, n_bins in levels:
+        np.frombuffer(buf, '<f8', count=n_bins, offset=offset)[:] = bin_times
+        env = np.frombuffer(buf, '<f4', count=len(values) * 2 * n_bins, offset=offset + n_bins * 8)
+        env.reshape(len(values), 2, n_bins)[:] = np.stack((mins, maxs), axis=1)
+        starts = np.arange(0, n_bins, PYRAMID_FANOUT)
+        bin_times = bin_times[starts]
+        mins = np.minimum.reduceat(mins, starts, axis=1)
+        maxs = np.maximum.reduceat(maxs, starts, axis=1)
+    return bytes(buf)
+
+class RecordingFile:
+    # Read side of the columnar format. It works on any buffer; open() maps
+    # a file so only the pages a view touches are read from disk. Columns
+    # are numbered as in RECORDING_COLUMNS.
+    def __init__(self, buffer):
+        header = np.frombuffer(buffer, RECORDING_HEADER, count=1)[0]
+        if header['magic'] != RECORDING_MAGIC:
+            raise ValueError("Not a recording")
+        n_columns, n = int(header['n_columns']), int(header['n_samples'])
+        self.chunk_size = int(header['chunk_size'])
+        self.bin_size = int(header['bin_size'])
+        self.fanout = int(header['fanout'])
+        index_dtype, n_chunks, index_offset, column_offsets, levels, _ = recording_layout(
+            n_columns, n, self.chunk_size, self.bin_size, self.fanout)
+        self.index = np.frombuffer(buffer, index_dtype, count=n_chunks, offset=index_offset)
+        self.data = tuple(np.frombuffer(buffer, dtype, count=n, offset=offset)
+                          for dtype, offset in zip(RECORDING_DTYPES, column_offsets))
+        self.levels = [(np.frombuffer(buffer, '<f8', count=n_bins, offset=offset),
+                        np.frombuffer(buffer, '<f4', count=(n_columns - 1) * 2 * n_bins,
+                                      offset=offset + n_bins * 8).reshape(n_columns - 1, 2, n_bins))
+                       for offset, n_bins in levels]
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as file:
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return len(self.data[0])
+
+    @property
+    def end_time(self):
+        return float(self.data[0][-1]) if len(self) else 0.0
+
+    def last(self):
+        return tuple(float(col[-1]) for col in self.data)
+
+    def span(self, t0, t1):
+        # Sample range [i0, i1) covering t0..t1, located through the chunk
+        # index so only the chunks at either end are searched
+        c0 = int(np.searchsorted(self.index['last'], t0))
+        c1 = int(np.searchsorted(self.index['first'], t1, side='right'))
+        lo, hi = c0 * self.chunk_size, min(c1 * self.chunk_size, len(self))
+        times = self.data[0]
+        return lo + int(np.searchsorted(times[lo:hi], t0)), lo + int(np.searchsorted(times[lo:hi], t1, side='right'))
+
+    def samples(self, t0, t1):
+        i0, i1 = self.span(t0, t1)
+        return tuple(col[i0:i1] for col in self.data)
+
+    def envelope(self, column, t0, t1, n_bins):
+        # Min/max line for t0..t1 at roughly n_bins resolution, taken from
+        # the coarsest pyramid level that still has n_bins bins in the span;
+        # short spans fall back to decimating the samples themselves
+        i0, i1 = self.span(t0, t1)
+        for level in range(len(self.levels) - 1, -1, -1):
+            size = self.bin_size * self.fanout ** level
+            if (i1 - i0) // size >= n_bins:
+                b0, b1 = i0 // size, -(-i1 // size)
+                bin_times, env = self.levels[level]
+                return np.repeat(bin_times[b0:b1], 2), env[column - 1, :, b0:b1].T.ravel().astype(float)
+        x, y = minmax_decimate(self.data[0][i0:i1], self.data[column][i0:i1], n_bins)
+        return np.array(x), np.array(y, dtype=float)
+
+def compress_recording(packed):
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=10).compress(packed)
+    return "zlib", zlib.compress(packed, 6)
+
+def decompress_recording(codec, blob):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
+
+def save_recording(c, patient_row_id, *columns):
+    # Short recordings are compressed into the row; long ones are written
+    # uncompressed next to the database so they can be mapped
+    packed = pack_recording(columns)
+    checksum = hashlib.sha256(packed).hexdigest()
+    path = None
+    if len(columns[0]) >= RECORDING_FILE_MIN_SAMPLES:
+        os.makedirs(RECORDINGS_DIR, exist_ok=True)
+        path = os.path.join(RECORDINGS_DIR, f"{patient_row_id}.urec")
+        with open(path + ".tmp", 'wb') as file:
+            file.write(packed)
+        os.replace(path + ".tmp", path)
+        codec, blob = "file", b""
+    else:
+        codec, blob = compress_recording(packed)
+    c.execute("INSERT OR REPLACE INTO recordings (patient_row_id, n_samples, columns, codec, data, checksum, path) VALUES (?, ?, ?, ?, ?, ?, ?)",
+              (patient_row_id, len(columns[0]), ",".join(RECORDING_COLUMNS), codec, blob, checksum, path))
+
+def open_recording(patient_row_id):
+    row = db.query_one("SELECT codec, data, path FROM recordings WHERE patient_row_id=?", (patient_row_id,))
+    if row is None:
+        return None
+    codec, blob, path = row
+    if codec == "file":
+        return RecordingFile.open(path)
+    return RecordingFile(decompress_recording(codec, blob))
+
+UroflowMetrics = collections.namedtuple(
+    "UroflowMetrics",
+    "qmax qave voided_volume voiding_time flow_time time_to_qmax segments pattern")
+
+NO_FLOW_METRICS = UroflowMetrics(0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0, "no flow")
+
+def running_median(values, n):
+    # Centred median over n samples, edges padded with the edge values
+    if n < 2 or len(values) < n:
+        return np.asarray(values, dtype=float)
+    padded = np.pad(np.asarray(values, dtype=float), (n // 2, n - 1 - n // 2), mode='edge')
+    return np.median(np.lib.stride_tricks.sliding_window_view(padded, n), axis=1)
+
+def flow_segments(times, flows):
+    # [start, stop) sample ranges of voiding: runs at or above FLOW_THRESHOLD,
+    # joined across short dips, without bursts too short to be a void
+    edges = np.diff(np.concatenate(([0], (flows >= FLOW_THRESHOLD).astype(np.int8), [0])))
+    starts, stops = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    if len(starts) > 1:
+        split = times[starts[1:]] - times[stops[:-1] - 1] >= FLOW_MERGE_GAP_S
+        starts = starts[np.concatenate(([True], split))]
+        stops = stops[np.concatenate((split, [True]))]
+    keep = times[stops - 1] - times[starts] >= FLOW_MIN_SEGMENT_S
+    return starts[keep], stops[keep]
+
+def flow_pattern(smoothed, qmax, n_segments):
+    if n_segments > 1:
+        return "intermittent"
+    # Count the rises and falls between turning points that are large
+    # next to Qmax; a bell curve has one rise and one fall. Checked before
+    # plateau, which a fluctuating curve can also satisfy.
+    slope = np.sign(np.diff(smoothed))
+    slope = slope[slope != 0]
+    turns = np.flatnonzero(slope[1:] != slope[:-1]) + 1
+    if len(turns):
+        levels = np.concatenate(([smoothed[0]], smoothed[np.flatnonzero(np.diff(smoothed))[turns]], [smoothed[-1]]))
+        if np.sum(np.abs(np.diff(levels)) >= STACCATO_SWING * qmax) > 2:
+            return "staccato"
+    if np.mean(smoothed >= PLATEAU_LEVEL * qmax) >= PLATEAU_FRACTION:
+        return "plateau"
+    return "bell"
+
+def analyze_uroflow(times, flows, volumes):
+    # ICS uroflowmetry parameters of one recording. Qmax is read from a
+    # running median so spikes shorter than about QMAX_MEDIAN_S / 2 (knocks,
+    # splashes) are rejected; time to Qmax and voiding time run from the
+    # first flow onset, and Qave is voided volume over flow time.
+    times = np.asarray(times, dtype=float)
+    flows = np.asarray(flows, dtype=float)
+    volumes = np.asarray(volumes, dtype=float)
+    if len(times) < 2:
+        return NO_FLOW_METRICS
+    starts, stops = flow_segments(times, flows)
+    if not len(starts):
+        return NO_FLOW_METRICS
+
+    first, last = starts[0], stops[-1]
+    dt = float(np.median(np.diff(times)))
+    window = int(round(QMAX_MEDIAN_S / dt)) if dt > 0 else 1
+    smoothed = running_median(flows[first:last], window)
+    peak = int(np.argmax(smoothed))
+    qmax = float(smoothed[peak])
+    flow_time = float(np.sum(times[stops - 1] - times[starts]))
+    voided_volume = max(0.0, float(np.max(volumes[first:]) - volumes[first]))
+    return UroflowMetrics(
+        qmax=qmax,
+        qave=voided_volume / flow_time if flow_time > 0 else 0.0,
+        voided_volume=voided_volume,
+        voiding_time=float(times[last - 1] - times[first]),
+        flow_time=flow_time,
+        time_to_qmax=float(times[first + peak] - times[first]),
+        segments=len(starts),
+        pattern=flow_pattern(smoothed, qmax, len(starts)),
+    )
+
+def analysis_key(checksum, config=None):
+    # recording_metrics key: content checksum and METRICS_VERSION for the
+    # analysis as recorded, plus a hash of the parameters for a re-analysis
+    key = f"{checksum}:{METRICS_VERSION}"
+    if config is not None:
+        key += ":" + hashlib.sha256(repr(tuple(config)).encode()).hexdigest()[:16]
+    return key
+
+def memoized_metrics(key, columns):
+    # Metrics under key, computed from columns() the first time and then
+    # read back from recording_metrics
+    cached = db.query_one("SELECT data FROM recording_metrics WHERE key=?", (key,))
+    if cached:
+        return UroflowMetrics(**json.loads(cached[0]))
+    times, flows, volumes = columns()[:3]
+    metrics = analyze_uroflow(times, flows, volumes)
+    db.execute("INSERT OR REPLACE INTO recording_metrics (key, data) VALUES (?, ?)",
+               (key, json.dumps(metrics._asdict())))
+    return metrics
+
+def recording_metrics(patient_row_id):
+    # Metrics of a stored recording, computed the first time they are asked
+    # for and then read back by content checksum
+    row = db.query_one("SELECT checksum FROM recordings WHERE patient_row_id=?", (patient_row_id,))
+    if row is None:
+        return None
+    return memoized_metrics(analysis_key(row[0]), lambda: open_recording(patient_row_id).data)
+
+def reanalyze(recording, config):
+    # (time, flow, volume, raw) of a stored recording recomputed under
+    # config. With the "raw" source, volume comes from the load cell counts
+    # and config.raw_scale (the firmware's C<n> calibration factor); a
+    # raw_offset of None takes the tare from the recording itself, as the
+    # counts at which the recorded weight was zero.
+    times, flows, volumes, raws = (np.asarray(column, dtype=float) for column in recording.data)
+    if config.source == "raw":
+        known = ~np.isnan(raws)
+        if np.count_nonzero(known) < 2:
+            raise ValueError("recording has no raw load cell counts")
+        if config.raw_offset is None:
+            config = config._replace(raw_offset=np.polyfit(volumes[known], raws[known], 1)[1])
+    volumes = source_weights(volumes, raws, config)
+    if config.source != "device":
+        flows = filter_flow(times, volumes, config)
+    return times, flows, volumes, raws
+
+reanalysis_cache = collections.OrderedDict()  # analysis key -> (RecordingFile, metrics)
+
+def reanalyzed_recording(patient_row_id, config=None):
+    # (RecordingFile, metrics) of a stored recording re-analysed under
+    # config, or as recorded when config is None; (None, None) without a
+    # recording. Re-analyses are memoised per recording checksum and
+    # parameter hash: the curves in memory for the last
+    # REANALYSIS_CACHE_SIZE, the metrics in recording_metrics.
+    row = db.query_one("SELECT checksum FROM recordings WHERE patient_row_id=?", (patient_row_id,))
+    if row is None:
+        return None, None
+    if config is None:
+        return open_recording(patient_row_id), recording_metrics(patient_row_id)
+    key = analysis_key(row[0], config)
+    if key in reanalysis_cache:
+        reanalysis_cache.move_to_end(key)
+        return reanalysis_cache[key]
+    columns = reanalyze(open_recording(patient_row_id), config)
+    result = RecordingFile(pack_recording(columns)), memoized_metrics(key, lambda: columns)
+    reanalysis_cache[key] = result
+    while len(reanalysis_cache) > REANALYSIS_CACHE_SIZE:
+        reanalysis_cache.popitem(last=False)
+    return result
+
+def metrics_text(metrics):
+    return (f"Qmax {metrics.qmax:.1f} ml/s   Qave {metrics.qave:.1f} ml/s   "
+            f"Vvoid {metrics.voided_volume:.0f} ml   {metrics.pattern}")
+
+class UroflowAccumulator:
+    # Running uroflow metrics for the test in progress, fed block by block
+    # from the ingest path. Every sample is looked at once: flow time,
+    # onset, segment count and voided volume are running sums and extremes,
+    # and Qmax is the running maximum of a trailing QMAX_MEDIAN_S median
+    # whose last window - 1 samples carry over to the next block. It uses
+    # the thresholds of analyze_uroflow, which stays the reference for the
+    # saved recording (bursts too short to count are only known afterwards).
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.qmax = 0.0
+        self.qmax_time = 0.0
+        self.onset = None
+        self.onset_volume = 0.0
+        self.max_volume = 0.0
+        self.flow_time = 0.0
+        self.segments = 0
+        self.last_flow = None  # time of the newest sample at or above FLOW_THRESHOLD
+        self.run_start = None  # start of the run of flow (merged across short dips) last seen
+        self.void_end = None  # newest flow in a run that lasted FLOW_MIN_SEGMENT_S
+        self.last_time = None
+        self.window = 0
+        self.tail_times = np.empty(0)
+        self.tail_flows = np.empty(0)
+
+    def extend(self, times, flows, volumes):
+        if not len(times):
+            return
+        if not self.window:
+            dt = float(np.median(np.diff(times))) if len(times) > 1 else SAMPLE_PERIOD_S
+            self.window = max(1, int(round(QMAX_MEDIAN_S / dt))) if dt > 0 else 1
+
+        flowing = np.flatnonzero(flows >= FLOW_THRESHOLD)
+        steps = np.diff(times, prepend=times[0] if self.last_time is None else self.last_time)
+        self.flow_time += float(steps[flowing].sum())
+        self.last_time = float(times[-1])
+        if len(flowing):
+            flow_times = times[flowing]
+            previous = np.concatenate(([-np.inf if self.last_flow is None else self.last_flow], flow_times[:-1]))
+            new = flow_times - previous >= FLOW_MERGE_GAP_S
+            self.segments += int(np.count_nonzero(new))
+            # Start time of the run each flow sample belongs to; only runs
+            # that last FLOW_MIN_SEGMENT_S count as voiding, as offline
+            run = np.maximum.accumulate(np.where(new, np.arange(len(new)), -1))
+            run_starts = np.where(run >= 0, flow_times[np.maximum(run, 0)],
+                                  np.nan if self.run_start is None else self.run_start)
+            lasting = np.flatnonzero(flow_times - run_starts >= FLOW_MIN_SEGMENT_S)
+            if len(lasting):
+                self.void_end = float(flow_times[lasting[-1]])
+            self.run_start = float(run_starts[-1])
+            self.last_flow = float(flow_times[-1])
+            if self.onset is None:
+                self.onset = float(flow_times[0])
+                self.onset_volume = self.max_volume = float(volumes[flowing[0]])
+                volumes = volumes[flowing[0]:]
+        if self.onset is not None and len(volumes):
+            self.max_volume = max(self.max_volume, float(volumes.max()))
+
+        all_times = np.concatenate((self.tail_times, times))
+        all_flows = np.concatenate((self.tail_flows, flows))
+        if len(all_flows) >= self.window:
+            medians = np.median(np.lib.stride_tricks.sliding_window_view(all_flows, self.window), axis=1)
+            peak = int(np.argmax(medians))
+            if medians[peak] > self.qmax:
+                self.qmax = float(medians[peak])
+                self.qmax_time = float(all_times[peak + self.window // 2])
+        keep = max(0, len(all_flows) - (self.window - 1))
+        self.tail_times, self.tail_flows = all_times[keep:], all_flows[keep:]
+
+    def no_flow_for(self):
+        # Seconds since the last run of flow long enough to be a void ended,
+        # 0 until there has been one; knocks and drips do not count
+        if self.void_end is None:
+            return 0.0
+        return self.last_time - self.void_end
+
+    def snapshot(self):
+        if self.onset is None:
+            return NO_FLOW_METRICS._replace(pattern="waiting for flow")
+        voided_volume = self.max_volume - self.onset_volume
+        return UroflowMetrics(
+            qmax=self.qmax,
+            qave=voided_volume / self.flow_time if self.flow_time > 0 else 0.0,
+            voided_volume=voided_volume,
+            voiding_time=self.last_flow - self.onset,
+            flow_time=self.flow_time,
+            time_to_qmax=max(0.0, self.qmax_time - self.onset),
+            segments=self.segments,
+            pattern="flow stopped" if self.last_time - self.last_flow >= FLOW_MERGE_GAP_S else "voiding",
+        )
+
+class SampleRingBuffer:
+    # Fixed-capacity (time, flow, volume) buffer for the live plot window.
+    # Every sample is written twice, at i and i + capacity, so the window is
+    # always one contiguous slice and can be handed to matplotlib as a view.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = np.zeros((3, 2 * capacity))
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def times(self):
+        return self.data[0, self.start:self.start + self.size]
+
+    @property
+    def flows(self):
+        return self.data[1, self.start:self.start + self.size]
+
+    @property
+    def volumes(self):
+        return self.data[2, self.start:self.start + self.size]
+
+    def last(self):
+        i = self.start + self.size - 1
+        return self.data[0, i], self.data[1, i], self.data[2, i]
+
+    def extend(self, times, flows, volumes):
+        block = np.vstack((times, flows, volumes))
+        n = block.shape[1]
+        if n >= self.capacity:
+            block = block[:, n - self.capacity:]
+            self.data[:, :self.capacity] = block
+            self.data[:, self.capacity:] = block
+            self.start = 0
+            self.size = self.capacity
+            return
+        overflow = self.size + n - self.capacity
+        if overflow > 0:
+            self.start = (self.start + overflow) % self.capacity
+            self.size -= overflow
+        idx = (self.start + self.size + np.arange(n)) % self.capacity
+        self.data[:, idx] = block
+        self.data[:, idx + self.capacity] = block
+        self.size += n
+
+    def evict_before(self, t):
+        # Times are monotonic, so the samples to drop are a prefix of the window
+        n = int(np.searchsorted(self.times, t, side='left'))
+        if n:
+            self.start = (self.start + n) % self.capacity
+            self.size -= n
+
+    def clear(self, capacity=None):
+        if capacity is not None and capacity != self.capacity:
+            self.capacity = capacity
+            self.data = np.zeros((3, 2 * capacity))
+        self.start = 0
+        self.size = 0
+
+class SessionRecorder:
+    # Append-only store for the whole acquisition, independent of the plot
+    # window. Samples are written into fixed-size NumPy chunks; a full chunk
+    # is kept as is and a new one started, so extending never copies old data.
+    def __init__(self, columns=3, chunk_size=RECORDER_CHUNK):
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.clear()
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.chunks = []
+        self.fill = self.chunk_size
+        self.count = 0
+
+    def new_chunk(self):
+        self.chunks.append(np.empty((self.chunk_size, self.columns)))
+        self.fill = 0
+
+    def extend(self, block):
+        # block has one row per sample and one column per recorded channel
+        block = np.asarray(block, dtype=float).reshape(-1, self.columns)
+        pos = 0
+        while pos < len(block):
+            if self.fill == self.chunk_size:
+                self.new_chunk()
+            n = min(self.chunk_size - self.fill, len(block) - pos)
+            self.chunks[-1][self.fill:self.fill + n] = block[pos:pos + n]
+            self.fill += n
+            self.count += n
+            pos += n
+
+    def columns_data(self):
+        if not self.count:
+            return tuple(np.empty(0) for _ in range(self.columns))
+        data = np.concatenate(self.chunks)[:self.count]
+        return tuple(data[:, i] for i in range(self.columns))
+
+def minmax_decimate(x, y, n_bins):
+    # Per-pixel min/max envelope: split the series into n_bins equal runs of
+    # samples and keep the lowest and highest sample of each, in time order.
+    # Peaks such as Qmax survive and at most 2 * n_bins + 2 points remain.
+    n = len(y)
+    if n <= 2 * n_bins:
+        return x, y
+    k = -(-n // n_bins)
+    m = n - n % k
+    body = y[:m].reshape(-1, k)
+    starts = np.arange(0, m, k)
+    parts = [starts + body.argmin(axis=1), starts + body.argmax(axis=1), [0, n - 1]]
+    if m < n:
+        tail = y[m:]
+        parts.append([m + tail.argmin(), m + tail.argmax()])
+    idx = np.unique(np.concatenate(parts))
+    return x[idx], y[idx]
+
+def read_recording_csv(filename):
+    with open(filename, mode='r') as file:
+        lines = file.readlines()[1:]
+    if not lines:
+        empty = np.empty(0)
+        return empty, empty, empty
+    data = np.loadtxt(lines, delimiter=',', ndmin=2)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+class RenderScheduler:
+    # Drives the live view from the Tk event loop at a fixed frame rate.
+    # tick() is called once per frame and returns False to stop the loop.
+    # A tick that fires more than half a period late counts as a late frame;
+    # every whole frame period it overran counts as a dropped frame.
+    def __init__(self, widget, tick, fps=RENDER_FPS):
+        self.widget = widget
+        self.tick = tick
+        self.period = 1.0 / fps
+        self.job = None
+        self.next_due = 0.0
+        self.frames = 0
+        self.late_frames = 0
+        self.dropped_frames = 0
+
+    def start(self):
+        self.stop()
+        self.next_due = time.perf_counter()
+        self.job = self.widget.after(0, self.run)
+
+    def stop(self):
+        if self.job:
+            self.widget.after_cancel(self.job)
+            self.job = None
+
+    def stats(self):
+        return {"frames": self.frames, "late": self.late_frames, "dropped": self.dropped_frames}
+
+    def run(self):
+        lag = time.perf_counter() - self.next_due
+        if lag > self.period / 2:
+            self.late_frames += 1
+            missed = int(lag // self.period)
+            self.dropped_frames += missed
+            self.next_due += missed * self.period
+        self.frames += 1
+        if not self.tick():
+            self.job = None
+            return
+        self.next_due += self.period
+        delay = max(1, int((self.next_due - time.perf_counter()) * 1000))
+        self.job = self.widget.after(delay, self.run)
+
+class BlitRenderer:
+    # Incremental renderer for the live figure. Axes, grid and tick labels are
+    # drawn once into a cached background; each frame restores it and draws
+    # only the lines. The background is rebuilt when the x-limits move or the
+    # canvas redraws for any other reason (resize, clear).
+    def __init__(self, canvas, axes, lines):
+        self.canvas = canvas
+        self.axes = axes
+        self.lines = lines
+        self.active = False
+        self.background = None
+        self.xlim = None
+        canvas.mpl_connect('draw_event', self.on_draw)
+
+    def start(self):
+        # Animated artists are left out of normal draws (and savefig), so
+        # they are only flagged while the live view is running
+        self.active = True
+        self.background = None
+        self.xlim = None
+        for line in self.lines:
+            line.set_animated(True)
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.background = None
+        for line in self.lines:
+            line.set_animated(False)
+        self.canvas.draw_idle()
+
+    def on_draw(self, event):
+        if self.active:
+            self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+            self.draw_lines()
+
+    def draw_lines(self):
+        for ax, line in zip(self.axes, self.lines):
+            ax.draw_artist(line)
+
+    def set_xlim(self, xmin, xmax):
+        if (xmin, xmax) != self.xlim:
+            self.xlim = (xmin, xmax)
+            for ax in self.axes:
+                ax.set_xlim(xmin, xmax)
+            self.background = None
+
+    def update(self):
+        if not self.active:
+            self.canvas.draw_idle()
+            return
+        if self.background is None:
+            # Full render; on_draw captures the new background
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_lines()
+        self.canvas.blit(self.canvas.figure.bbox)
+
+# Binary frame of New_RAW_Calibration_v5, little-endian, CRC16-CCITT over bytes 2..19
+FRAME_DTYPE = np.dtype([('sync', '<u2'), ('seq', '<u2'), ('millis', '<u4'), ('raw', '<i4'),
+                        ('flow', '<f4'), ('volume', '<f4'), ('crc', '<u2')])
+FRAME_SIZE = FRAME_DTYPE.itemsize
+
+def crc16_table():
+    table = np.zeros(256, dtype=np.uint16)
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table[i] = crc & 0xFFFF
+    return table
+
+CRC16_TABLE = crc16_table()
+
+class FrameDecoder:
+    # Decodes every complete binary frame in a read() chunk at once. Sync words
+    # are located and all candidate frames CRC-checked as whole arrays, one
+    # NumPy step per byte column rather than per frame. Bytes that may start
+    # an unfinished frame are carried over to the next feed().
+    def __init__(self):
+        self.pending = b''
+        self.text = []
+        self.text_pending = b''
+        self.last_seq = None
+        self.frames = 0
+        self.crc_errors = 0
+        self.lost_frames = 0
+
+    def feed(self, chunk):
+        buf = self.pending + chunk
+        data = np.frombuffer(buf, dtype=np.uint8)
+        limit = len(data) - FRAME_SIZE + 1
+        if limit <= 0:
+            self.pending = buf
+            return np.empty(0, dtype=FRAME_DTYPE)
+        cand = np.flatnonzero((data[:limit] == 0xA5) & (data[1:limit + 1] == 0x5A))
+        rows = data[cand[:, None] + np.arange(FRAME_SIZE)]
+        crc = np.full(len(cand), 0xFFFF, dtype=np.uint16)
+        for col in range(2, FRAME_SIZE - 2):
+            crc = (crc << 8) ^ CRC16_TABLE[(crc >> 8) ^ rows[:, col]]
+        ok = crc == (rows[:, -2] | (rows[:, -1].astype(np.uint16) << 8))
+        starts = cand[ok]
+        if len(starts) > 1:
+            # A frame can't start inside the previous one
+            keep = np.concatenate(([True], np.diff(starts) >= FRAME_SIZE))
+            starts = starts[keep]
+            rows = rows[ok][keep]
+        else:
+            rows = rows[ok]
+
+        # Sync bytes inside a good frame's payload are not CRC errors
+        bad = cand[~ok]
+        if len(bad):
+            owner = np.searchsorted(starts, bad, side='right') - 1
+            inside = (owner >= 0) & (bad - starts[np.maximum(owner, 0)] < FRAME_SIZE)
+            self.crc_errors += int(np.count_nonzero(~inside))
+
+        consumed = starts[-1] + FRAME_SIZE if len(starts) else 0
+        keep_from = max(consumed, limit)
+        self.pending = buf[keep_from:]
+
+        # Whatever lies between frames is the firmware's text output
+        covered = np.zeros(keep_from, dtype=bool)
+        covered[(starts[:, None] + np.arange(FRAME_SIZE)).ravel()] = True
+        *lines, rest = (self.text_pending + data[:keep_from][~covered].tobytes()).split(b'\n')
+        self.text_pending = rest[-TEXT_LINE_LIMIT:]
+        self.text.extend(line.decode(errors="ignore").strip() for line in lines)
+
+        frames = np.ascontiguousarray(rows).view(FRAME_DTYPE).reshape(-1)
+        if len(frames):
+            seq = frames['seq'].astype(np.int64)
+            if self.last_seq is not None:
+                seq = np.concatenate(([self.last_seq], seq))
+            self.lost_frames += int(((np.diff(seq) - 1) % 65536).sum())
+            self.last_seq = int(frames['seq'][-1])
+            self.frames += len(frames)
+        return frames
+
+    def take_text(self):
+        text, self.text = self.text, []
+        return text
+
+class LineDecoder:
+    # Splits a read() chunk into complete "flow,volume[,millis]" lines and
+    # converts them in one NumPy call; millis is NaN for v4 lines. Other lines
+    # (banner, command replies) are skipped and an unfinished line is carried
+    # over to the next feed().
+    def __init__(self):
+        self.pending = b''
+        self.text = []
+
+    def feed(self, chunk):
+        buf = self.pending + chunk
+        end = buf.rfind(b'\n')
+        if end < 0:
+            self.pending = buf
+            return np.empty((0, 3))
+        self.pending = buf[end + 1:]
+        lines = np.array(buf[:end].split(b'\n'))
+        commas = np.char.count(lines, b',')
+        is_data = (commas == 1) | (commas == 2)
+        if not is_data.all():
+            self.text.extend(line.decode(errors="ignore").strip() for line in lines[~is_data])
+        lines = lines[is_data]
+        if not len(lines):
+            return np.empty((0, 3))
+        head = np.char.partition(lines, b',')
+        tail = np.char.partition(head[:, 2], b',')
+        fields = np.column_stack((head[:, 0], tail[:, 0], np.where(tail[:, 2] == b'', b'nan', tail[:, 2])))
+        try:
+            return fields.astype(float)
+        except ValueError:
+            return self.parse_rows(fields)
+
+    def parse_rows(self, fields):
+        rows = []
+        for flow, volume, millis in fields:
+            try:
+                rows.append((float(flow), float(volume), float(millis)))
+            except ValueError:
+                continue
+        return np.array(rows, dtype=float).reshape(-1, 3)
+
+    def take_text(self):
+        text, self.text = self.text, []
+        return text
+
+class DeviceClock:
+    # Maps the firmware's millis() counter onto the host perf_counter timeline.
+    # 32-bit wraparound is unwrapped, a jump backwards (board reset) starts a
+    # new mapping, and the board oscillator's drift is tracked as a slowly
+    # adapting rate once the session is long enough to measure it.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.last_ms = None
+        self.epoch_ms = 0
+        self.origin_ms = None
+        self.origin_host = None
+        self.rate = 1.0
+
+    def convert(self, millis, host_now):
+        ms = np.asarray(millis, dtype=np.int64)
+        prev = np.concatenate(([ms[0] if self.last_ms is None else self.last_ms], ms[:-1]))
+        step = ms - prev
+        wrapped = step < -(MILLIS_WRAP // 2)
+        restarts = np.flatnonzero((step < 0) & ~wrapped)
+        if len(restarts):
+            i = restarts[0]
+            before = self.convert(ms[:i], host_now) if i else np.empty(0)
+            self.reset()
+            return np.concatenate((before, self.convert(ms[i:], host_now)))
+
+        unwrapped = ms + self.epoch_ms + np.cumsum(wrapped) * MILLIS_WRAP
+        self.epoch_ms += int(wrapped.sum()) * MILLIS_WRAP
+        self.last_ms = int(ms[-1])
+        if self.origin_ms is None:
+            # Anchor on arrival of the newest sample
+            self.origin_ms = unwrapped[0]
+            self.origin_host = host_now - (unwrapped[-1] - unwrapped[0]) / 1000.0
+        elapsed = (unwrapped - self.origin_ms) / 1000.0
+        if elapsed[-1] > CLOCK_DRIFT_BASELINE_S:
+            # Transport delay is small next to the baseline, so the ratio of
+            # host to device elapsed time is the oscillator's rate error
+            measured = (host_now - self.origin_host) / elapsed[-1]
+            self.rate += 0.05 * (min(max(measured, 0.98), 1.02) - self.rate)
+        return self.origin_host + elapsed * self.rate
+
+def source_weights(volumes, raws, config):
+    # Grams from the configured source; samples without raw counts (text
+    # protocol) keep the firmware's weight
+    if config.source != "raw":
+        return volumes
+    center, coefficients = config.calibration or (0.0, (1.0 / config.raw_scale, 0.0))
+    grams = np.polyval(coefficients, raws - center) - np.polyval(coefficients, config.raw_offset - center)
+    return np.where(np.isnan(raws), volumes, grams)
+
+def savgol_taps(window, order):
+    # Savitzky-Golay: the slope of a least-squares polynomial through the
+    # window, at its centre, as weights on the samples oldest first
+    offsets = np.arange(window) - window // 2
+    return np.linalg.pinv(np.vander(offsets, order + 1, increasing=True))[1]
+
+def butterworth_taps(cutoff_hz, rate_hz):
+    # 2nd order Butterworth low-pass by the bilinear transform, run until its
+    # impulse response has decayed and kept as FIR taps (newest first) with
+    # unity gain at DC
+    k = np.tan(np.pi * min(cutoff_hz / rate_hz, 0.45))
+    norm = 1.0 / (1.0 + np.sqrt(2.0) * k + k * k)
+    b = (k * k * norm, 2.0 * k * k * norm, k * k * norm)
+    a1, a2 = 2.0 * (k * k - 1.0) * norm, (1.0 - np.sqrt(2.0) * k + k * k) * norm
+    h = np.zeros(FILTER_MAX_TAPS)
+    y1 = y2 = 0.0
+    for n in range(FILTER_MAX_TAPS):
+        h[n] = y = (b[n] if n < 3 else 0.0) - a1 * y1 - a2 * y2
+        y1, y2 = y, y1
+    h = h[:np.flatnonzero(np.abs(h) >= FILTER_IMPULSE_TOL * np.abs(h).max())[-1] + 1]
+    return h / h.sum()
+
+def differentiator(config, period):
+    # (weights oldest first, index of the sample the output belongs to)
+    if config.differentiator == "butterworth":
+        h = butterworth_taps(config.cutoff_hz, 1.0 / period)
+        taps = np.convolve(h, (1.0, -1.0))
+        delay = np.dot(np.arange(len(h)), h) + 0.5  # group delay at DC
+        return taps[::-1], len(taps) - 1 - int(round(delay))
+    window = config.window | 1
+    return savgol_taps(window, config.order), window // 2
+
+def centred_fir(x, weights):
+    # Zero-phase: odd-length weights applied about each sample, the ends
+    # extended by point reflection so that trends (and time) carry on
+    half = len(weights) // 2
+    padded = np.pad(x, half, mode='reflect', reflect_type='odd')
+    return np.lib.stride_tricks.sliding_window_view(padded, len(weights)) @ weights
+
+def filter_flow(times, weights, config):
+    # Offline counterpart of HostFilter over a whole recording. Every stage
+    # is centred, so flow is not shifted in time against volume.
+    if len(times) < 2:
+        return np.zeros(len(times))
+    if config.median > 1:
+        weights = running_median(weights, config.median | 1)
+    if config.differentiator == "butterworth":
+        h = butterworth_taps(config.cutoff_hz, 1.0 / np.median(np.diff(times)))
+        flow = np.gradient(centred_fir(weights, np.convolve(h, h[::-1])), times)
+    else:
+        taps = savgol_taps(config.window | 1, config.order)
+        flow = centred_fir(weights, taps) / centred_fir(times, taps)
+    return np.maximum(flow, 0.0)
+
+class StreamingWindow:
+    # A sliding-window stage run block by block. The last length - 1 inputs
+    # carry over to the next block, so the output does not depend on how the
+    # stream was chunked; output k belongs to input k + centre.
+    def __init__(self, length, centre, reduce):
+        self.length = length
+        self.centre = centre
+        self.reduce = reduce
+        self.history = None
+
+    def process(self, x):
+        data = x if self.history is None else np.concatenate((self.history, x))
+        self.history = data[max(0, len(data) - self.length + 1):]
+        if len(data) < self.length:
+            return data[:0]
+        return self.reduce(np.lib.stride_tricks.sliding_window_view(data, self.length, axis=0))
+
+class HostFilter:
+    # Streaming flow from weight on the host, in place of the firmware's
+    # moving average: spike-rejecting median, then a differentiating FIR.
+    # Time goes through the same stages as weight (the median of increasing
+    # times is the centre sample's), so flow is d(weight) / d(time) and does
+    # not assume a steady sample rate. Rows come out late by the chain's
+    # delay but carry the time of the sample they belong to, so the delay
+    # does not shift Qmax. zero is the host's tare in raw counts, which a
+    # filter rebuilt for a new calibration takes over from the old one.
+    def __init__(self, config=HOST_FILTER, zero=None):
+        self.config = config
+        self.zero = zero
+        self.reset()
+
+    def reset(self):
+        self.stages = None
+        self.pending = np.empty((0, 4))
+        self.skip = 0
+        self.rezero = False
+
+    def tare(self):
+        # Called from other threads: the next raw counts become zero grams
+        self.rezero = True
+
+    def design(self, period):
+        self.stages = []
+        if self.config.median > 1:
+            n = self.config.median | 1
+            self.stages.append(StreamingWindow(n, n // 2, lambda w: np.median(w, axis=-1)))
+        taps, centre = differentiator(self.config, period)
+        self.stages.append(StreamingWindow(len(taps), centre, lambda w: w @ taps))
+        self.skip = sum(stage.centre for stage in self.stages)
+
+    def process(self, block):
+        # (time, flow, volume, raw) rows in, the rows the chain has caught up
+        # with out, their flow replaced and volume in grams from the source
+        if not len(block):
+            return block
+        if self.zero is None or self.rezero:
+            known = block[~np.isnan(block[:, 3]), 3]
+            if len(known):
+                # Tare on the host, as the firmware does at boot and on "T"
+                self.zero = float(known[0])
+                self.rezero = False
+        if self.config.source == "device":
+            return block
+        block = block.copy()
+        config = self.config
+        if config.source == "raw" and config.raw_offset is None:
+            config = config._replace(source="weight") if self.zero is None else config._replace(raw_offset=self.zero)
+        block[:, 2] = source_weights(block[:, 2], block[:, 3], config)
+        if self.stages is None:
+            self.design(np.median(np.diff(block[:, 0])) if len(block) > 1 else SAMPLE_PERIOD_S)
+        x = block[:, [0, 2]]
+        for stage in self.stages:
+            x = stage.process(x)
+        rows = np.concatenate((self.pending, block))
+        drop = min(self.skip, len(rows))
+        self.skip -= drop
+        rows = rows[drop:]
+        self.pending = rows[len(x):]
+        rows = rows[:len(x)]
+        rows[:, 1] = np.maximum(x[:, 1] / x[:, 0], 0.0)
+        return rows
+
+def benchmark_filter(config, n_samples, block_size):
+    # Samples per second through HostFilter fed block_size rows at a time,
+    # and through filter_flow, on a synthetic 20 ml/s void with load cell
+    # noise and spikes
+    rng = np.random.default_rng(0)
+    times = np.arange(n_samples) * SAMPLE_PERIOD_S
+    flows = 20.0 * np.sin(np.pi * (times % 30.0) / 30.0) ** 2
+    weights = np.cumsum(flows) * SAMPLE_PERIOD_S + rng.normal(0.0, 0.2, n_samples)
+    weights[rng.integers(0, n_samples, n_samples // 500)] += 50.0
+    block = np.column_stack((times, flows, weights, np.full(n_samples, np.nan)))
+    chain = HostFilter(config._replace(source="weight"))
+    start = time.perf_counter()
+    for i in range(0, n_samples, block_size):
+        chain.process(block[i:i + block_size])
+    streaming = n_samples / (time.perf_counter() - start)
+    start = time.perf_counter()
+    filter_flow(times, weights, config)
+    return streaming, n_samples / (time.perf_counter() - start)
+
+def fit_calibration(raws, grams, degree=1):
+    # Least-squares polynomial from load cell counts to grams, as a
+    # (center, coefficients) profile, and its RMS error in grams. Counts are
+    # taken about their mean so higher powers stay well conditioned.
+    raws = np.asarray(raws, dtype=float)
+    grams = np.asarray(grams, dtype=float)
+    if len(np.unique(raws)) <= degree:
+        raise ValueError(f"A degree {degree} fit needs at least {degree + 1} different reference weights")
+    center = float(raws.mean())
+    coefficients = np.polyfit(raws - center, grams, degree)
+    residual = float(np.sqrt(np.mean((np.polyval(coefficients, raws - center) - grams) ** 2)))
+    return (center, tuple(float(c) for c in coefficients)), residual
+
+def save_calibration(device, points, degree):
+    # Fit points ([counts, grams] pairs) and store the profile as the
+    # device's active one; earlier profiles are kept, inactive
+    raws, grams = np.asarray(points, dtype=float).T
+    (center, coefficients), residual = fit_calibration(raws, grams, degree)
+    with db.transaction() as c:
+        c.execute("UPDATE calibration_profiles SET active=0 WHERE device=?", (device,))
+        c.execute("INSERT INTO calibration_profiles (device, created, center, coefficients, points, residual) "
+                  "VALUES (?, ?, ?, ?, ?, ?)",
+                  (device, datetime.datetime.now().isoformat(timespec="seconds"), center,
+                   json.dumps(coefficients), json.dumps([list(point) for point in points]), residual))
+    return (center, coefficients), residual
+
+def active_calibration(device):
+    row = db.query_one("SELECT center, coefficients FROM calibration_profiles "
+                       "WHERE device=? AND active=1 ORDER BY id DESC", (device,))
+    return None if row is None else (row[0], tuple(json.loads(row[1])))
 
 class SerialReader(threading.Thread):
-    def __init__(self, port, baudrate, data_queue, stop_event):
-        super().__init__()
-        self.port = port
-        self.baudrate = baudrate
-        self.data_queue = data_queue
-        self.stop_event = stop_event
+    # The link's I/O thread: the only code that touches the port. It reads
+    # and decodes the sample stream, writes queued commands and hands text
+    # lines to the link for acknowledgement matching.
+    def __init__(self, link):
+        super().__init__(daemon=True)
+        self.link = link
+        self.protocol = link.protocol
+        self.decoder = FrameDecoder() if link.protocol == "binary" else LineDecoder()
+        self.clock = DeviceClock()
+        self.filter = HostFilter(link.filter_config)
+        self.device = None
+        self.volume_offset = 0.0  # carries the firmware's weight across its re-tare on reconnect
+        self.last_volume = None
+        self.last_time = None
+        self.ready = False
         self.ser = None
 
     def run(self):
-        try:
-            if serial is None:
-                raise ImportError("pyserial not installed")
-            self.ser = serial.Serial(self.port, self.baudrate, timeout=1)
-            while not self.stop_event.is_set():
-                line = self.ser.readline()
-                if line:
+        # Supervisor loop: find the board, stream until the link breaks, then
+        # retry with exponential backoff until the link is closed
+        if serial is None:
+            self.link.fail("pyserial not installed")
+            return
+        backoff = RECONNECT_MIN_S
+        while not self.link.stop_event.is_set():
+            try:
+                self.link.set_state("connecting")
+                self.ser, initial = self.link.discover()
+                if self.ser is None:
+                    raise SerialException("No UROSON device found")
+                self.start_stream(initial)
+                backoff = RECONNECT_MIN_S
+                self.read_chunks()
+            except (SerialException, OSError) as e:
+                self.link.disconnected(str(e))
+                self.link.stop_event.wait(backoff)
+                backoff = min(backoff * 2, RECONNECT_MAX_S)
+            finally:
+                if self.ser:
                     try:
-                        parts = line.decode(errors="ignore").strip().split(',')
-                        if len(parts) == 2:
-                            flow, volume = float(parts[0]), float(parts[1])
-                            self.data_queue.put((flow, volume))
-                    except ValueError:
-                        continue
-            self.ser.close()
-        except (serial.SerialException, ImportError) as e:
-            self.data_queue.put(('error', str(e)))
+                        self.ser.close()
+                    except (SerialException, OSError):
+                        pass
+                    self.ser = None
+        self.link.set_state("closed")
+
+    def start_stream(self, initial):
+        self.protocol = self.link.protocol
+        self.decoder = FrameDecoder() if self.protocol == "binary" else LineDecoder()
+        self.clock.reset()
+        # The board resets and re-tares when the port reopens. On a reconnect
+        # to the same board the host keeps its tare (raw counts are
+        # absolute) and the firmware's weight continues from where it was,
+        # so a session survives the glitch without a jump in volume.
+        same_board = self.device is not None and self.device == self.link.device
+        self.device = self.link.device
+        self.filter = HostFilter(self.link.host_filter(), self.filter.zero if same_board else None)
+        self.volume_offset = self.last_volume if same_board and self.last_volume is not None else 0.0
+        self.ready = False
+        self.link.connected()
+        if initial:
+            self.handle_chunk(initial)
+
+    def read_chunks(self):
+        # One read() takes everything the OS has buffered (blocking for the
+        # first byte), and everything decoded from it goes out as one block
+        last_request = 0.0
+        requests = 0
+        while not self.link.stop_event.is_set():
+            if self.protocol == "binary" and not self.decoder.frames and time.monotonic() - last_request > 1.0:
+                if requests == BINARY_REQUESTS:
+                    # Firmware older than v5 has no binary mode: read its text
+                    # lines for the rest of this connection
+                    self.protocol = "ascii"
+                    self.decoder = LineDecoder()
+                else:
+                    # The board resets when the port opens and boots in text
+                    # mode, so keep asking for binary frames until they arrive
+                    self.ser.write(b"B")
+                    last_request = time.monotonic()
+                    requests += 1
+            if self.ready:
+                # Commands are held until the board is past its reset and streaming
+                self.link.write_commands(self.ser)
+            chunk = self.ser.read(self.ser.in_waiting or 1)
+            if chunk:
+                self.handle_chunk(chunk)
+            self.link.expire_commands()
+
+    def handle_chunk(self, chunk):
+        block = self.decode(chunk)
+        self.link.received(len(chunk), len(block), self.decoder)
+        if len(block):
+            self.ready = True
+            self.link.publish(('samples', block))
+        for line in self.decoder.take_text():
+            self.link.acknowledge(line)
+
+    def decode(self, chunk):
+        # Samples are stamped here, on arrival, as (time, flow, volume, raw)
+        # rows; raw load cell counts only come with binary frames. Unless the
+        # firmware's flow is used, flow is then derived by the host filter.
+        now = time.perf_counter_ns() / 1e9
+        if self.protocol == "binary":
+            frames = self.decoder.feed(chunk)
+            flows, volumes, millis = frames['flow'], frames['volume'], frames['millis'].astype(float)
+            raws = frames['raw']
+        else:
+            rows = self.decoder.feed(chunk)
+            flows, volumes, millis = rows[:, 0], rows[:, 1], rows[:, 2]
+            raws = np.full(len(rows), np.nan)
+        if not len(flows):
+            return np.empty((0, 4))
+        if np.isnan(millis).any():
+            times = self.arrival_times(len(flows), now)
+        else:
+            times = self.clock.convert(millis, now)
+        self.last_time = times[-1]
+        volumes = volumes + self.volume_offset
+        self.last_volume = float(volumes[-1])
+        if self.link.recalibrated:
+            # A new profile keeps the current tare: whatever is on the scale
+            # now (often the last reference weight) must not become zero
+            self.link.recalibrated = False
+            self.filter = HostFilter(self.link.host_filter(), self.filter.zero)
+        return self.filter.process(np.column_stack((times, flows, volumes, raws)))
+
+    def arrival_times(self, n, now):
+        # No device clock: the newest sample is stamped on arrival and the
+        # rest are spaced back from it at the nominal period
+        times = now - SAMPLE_PERIOD_S * np.arange(n - 1, -1, -1)
+        if self.last_time is not None and times[0] <= self.last_time:
+            times = np.linspace(self.last_time, now, n + 1)[1:]
+        return times
+
+class SerialLink:
+    # The single long-lived connection to the board. Opening the port resets
+    # an Arduino, so it is opened once and shared: the sample stream fans out
+    # to subscribed queues and commands (T, C<n>, ...) go through an outbound
+    # queue. A command may name a reply pattern; its future then resolves
+    # with the matching line from the firmware, or fails after a timeout.
+    # The reader rediscovers and reconnects the board after USB glitches;
+    # subscribers keep their queues, so a session survives a disconnect.
+    def __init__(self, port, baudrate, protocol=SERIAL_PROTOCOL, filter_config=HOST_FILTER):
+        self.port = port
+        self.baudrate = baudrate
+        self.protocol = protocol
+        self.filter_config = filter_config
+        self.device = None
+        self.recalibrated = False
+        self.stop_event = threading.Event()
+        self.reader = None
+        self.subscribers = []
+        self.commands = queue.Queue()
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.stats = {"connects": 0, "disconnects": 0, "bytes": 0, "samples": 0,
+                      "crc_errors": 0, "lost_frames": 0, "last_error": "",
+                      "connected_at": None, "last_sample_at": None}
+
+    @property
+    def is_open(self):
+        return bool(self.reader and self.reader.is_alive())
+
+    def open(self):
+        if self.is_open:
+            return
+        self.stop_event.clear()
+        self.reader = SerialReader(self)
+        self.reader.start()
+
+    def close(self):
+        self.stop_event.set()
+        if self.reader:
+            self.reader.join(timeout=1)
+            self.reader = None
+
+    def candidate_ports(self):
+        # Last good port first, then USB serial adapters, then the rest
+        ports = list_ports.comports() if list_ports else []
+        usb = [p.device for p in ports if p.vid is not None]
+        other = [p.device for p in ports if p.vid is None]
+        names = [self.port] + usb + other
+        return list(dict.fromkeys(name for name in names if name))
+
+    def discover(self):
+        # Returns an open port that speaks the firmware's protocol and the
+        # bytes already read from it, or (None, b'') if nothing answered
+        for port in self.candidate_ports():
+            for baudrate in dict.fromkeys((self.baudrate,) + BAUDRATES):
+                if self.stop_event.is_set():
+                    return None, b''
+                try:
+                    ser, seen = self.probe(port, baudrate)
+                except (SerialException, OSError):
+                    break  # port missing or busy, no point trying other rates
+                if ser:
+                    self.port, self.baudrate = port, baudrate
+                    self.device = self.device_id(port)
+                    return ser, seen
+        return None, b''
+
+    def device_id(self, port):
+        # The USB adapter's serial number, so a board keeps its calibration
+        # when it comes up on another port; the port name without one
+        for p in (list_ports.comports() if list_ports else []):
+            if p.device == port and p.vid is not None and p.serial_number:
+                return f"{p.vid:04x}:{p.pid:04x}:{p.serial_number}"
+        return port
+
+    def host_filter(self):
+        # The board's active calibration profile, if it has one, turns its
+        # raw counts into grams on the host
+        calibration = active_calibration(self.device) if self.device else None
+        if calibration is None:
+            return self.filter_config
+        return self.filter_config._replace(source="raw", calibration=calibration, raw_offset=None)
+
+    def recalibrate(self):
+        # A profile was saved: the reader rebuilds its filter on the next block
+        self.recalibrated = True
+
+    def tare(self):
+        # Zero the host's weight along with the firmware's
+        reader = self.reader
+        if reader:
+            reader.filter.tare()
+            reader.volume_offset = 0.0
+
+    def probe(self, port, baudrate):
+        ser = serial.Serial(port, baudrate, timeout=SERIAL_READ_TIMEOUT_S)
+        seen = b''
+        deadline = time.monotonic() + PROBE_S
+        try:
+            while time.monotonic() < deadline and not self.stop_event.is_set():
+                seen += ser.read(ser.in_waiting or 1)
+                if FIRMWARE_BANNER in seen or DATA_LINE_RE.search(seen) or len(FrameDecoder().feed(seen)):
+                    return ser, seen
+        except (SerialException, OSError):
+            ser.close()
+            raise
+        ser.close()
+        return None, b''
+
+    def set_state(self, state):
+        self.state = state
+
+    def connected(self):
+        self.state = "connected"
+        self.stats["connects"] += 1
+        self.stats["connected_at"] = time.monotonic()
+
+    def disconnected(self, message):
+        if self.state == "connected":
+            self.stats["disconnects"] += 1
+        self.state = "reconnecting"
+        self.stats["last_error"] = message
+        self.stats["connected_at"] = None
+        self.fail_commands(SerialException(message))
+
+    def received(self, n_bytes, n_samples, decoder):
+        self.stats["bytes"] += n_bytes
+        self.stats["samples"] += n_samples
+        if n_samples:
+            self.stats["last_sample_at"] = time.monotonic()
+        if isinstance(decoder, FrameDecoder):
+            self.stats["crc_errors"] = decoder.crc_errors
+            self.stats["lost_frames"] = decoder.lost_frames
+
+    def health(self):
+        health = dict(self.stats, state=self.state, port=self.port, baudrate=self.baudrate)
+        now = time.monotonic()
+        health["uptime_s"] = now - health.pop("connected_at") if self.stats["connected_at"] else 0.0
+        last = health.pop("last_sample_at")
+        health["last_sample_age_s"] = now - last if last else None
+        return health
+
+    def status_text(self):
+        if self.state == "connected":
+            return f"{self.port} @ {self.baudrate}"
+        if self.state == "reconnecting":
+            return f"Reconnecting... ({self.stats['last_error']})"
+        return self.state.capitalize()
+
+    def subscribe(self, data_queue):
+        with self.lock:
+            if data_queue not in self.subscribers:
+                self.subscribers.append(data_queue)
+        self.open()
+
+    def unsubscribe(self, data_queue):
+        with self.lock:
+            if data_queue in self.subscribers:
+                self.subscribers.remove(data_queue)
+
+    def publish(self, item):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for data_queue in subscribers:
+            data_queue.put(item)
+
+    def send_command(self, command, ack=None, timeout=COMMAND_TIMEOUT_S):
+        if isinstance(command, str):
+            command = command.encode('ascii')
+        future = concurrent.futures.Future()
+        self.commands.put((command, re.compile(ack) if ack else None, timeout, future))
+        self.open()
+        return future
+
+    def write_commands(self, ser):
+        while True:
+            try:
+                command, ack, timeout, future = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            ser.write(command)
+            if ack is None:
+                future.set_result(None)
+            else:
+                self.pending.append((ack, time.monotonic() + timeout, future))
+
+    def acknowledge(self, line):
+        for entry in self.pending:
+            if entry[0].search(line):
+                self.pending.remove(entry)
+                entry[2].set_result(line)
+                return
+
+    def expire_commands(self):
+        now = time.monotonic()
+        while self.pending and self.pending[0][1] < now:
+            self.pending.popleft()[2].set_exception(TimeoutError("No reply from device"))
+
+    def fail(self, message):
+        # Unrecoverable (no pyserial): fail every waiting command and tell the subscribers
+        self.state = "closed"
+        self.fail_commands(SerialException(message))
+        self.publish(('error', message))
+
+    def fail_commands(self, error):
+        while self.pending:
+            self.pending.popleft()[2].set_exception(error)
+        while True:
+            try:
+                future = self.commands.get_nowait()[3]
+            except queue.Empty:
+                break
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
+
+def patient_search_filter(text="", date_from=None, date_to=None, hospital_id=None, doctor_id=None):
+    # WHERE clause and parameters for PatientHistory.search. Every word of
+    # text must prefix-match the FTS index; words are quoted so input is
+    # never parsed as FTS syntax. Dates are yyyy-mm-dd, so ranges compare
+    # as text on idx_patients_date.
+    clauses, params = [], []
+    terms = " ".join('"' + word.replace('"', '""') + '"*' for word in text.split())
+    if terms:
+        clauses.append("id IN (SELECT rowid FROM patients_fts WHERE patients_fts MATCH ?)")
+        params.append(terms)
+    if date_from:
+        clauses.append("date >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append("date <= ?")
+        params.append(date_to)
+    if hospital_id is not None:
+        clauses.append("hospital_id = ?")
+        params.append(hospital_id)
+    if doctor_id is not None:
+        clauses.append("doctor_id = ?")
+        params.append(doctor_id)
+    return " AND ".join(clauses) or "1", tuple(params)
+
+class PatientHistory:
+    # Keyset-paginated patient list for the Report window, newest first.
+    # Only a sliding window of pages lives in the Treeview: scrolling near
+    # either end fetches the neighbouring page by id and drops the page at
+    # the far end. Rows are numbered by rank among the rows matching the
+    # current search, 1 being the oldest.
+    def __init__(self, tree, page_size=REPORT_PAGE_SIZE, max_pages=REPORT_MAX_PAGES):
+        self.tree = tree
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = collections.deque()  # row ids per loaded page, newest first
+        self.top_number = 0
+        self.scheduled = False
+        self.where, self.params = "1", ()
+
+    def search(self, where, params):
+        self.where, self.params = where, params
+        self.reload()
+
+    def fetch(self, where, params, ascending=False):
+        rows = db.query(f"SELECT id, first_name, last_name, date, time FROM patients WHERE ({self.where}) AND {where} "
+                        f"ORDER BY id {'ASC' if ascending else 'DESC'} LIMIT ?", (*self.params, *params, self.page_size))
+        return rows[::-1] if ascending else rows
+
+    def number_of(self, row_id):
+        return db.query_one(f"SELECT COUNT(*) FROM patients WHERE ({self.where}) AND id <= ?",
+                            (*self.params, row_id))[0]
+
+    def insert(self, rows, index, number):
+        for i, (row_id, first, last, date, time_) in enumerate(rows):
+            self.tree.insert("", "end" if index is None else index + i, iid=row_id,
+                             values=(number - i, f"{first} {last}", date, time_))
+
+    def reload(self):
+        self.tree.delete(*self.tree.get_children())
+        self.pages.clear()
+        rows = self.fetch("1", ())
+        if rows:
+            self.top_number = self.number_of(rows[0][0])
+            self.insert(rows, None, self.top_number)
+            self.pages.append([row[0] for row in rows])
+
+    def on_scroll(self, first, last):
+        # Hooked into yscrollcommand; paging waits for idle so it never runs
+        # inside Tk's own scroll update
+        if not self.scheduled:
+            self.scheduled = True
+            self.tree.after_idle(self.fill, float(first), float(last))
+
+    def fill(self, first, last):
+        self.scheduled = False
+        if last > 0.9:
+            self.load_older()
+        elif first < 0.1:
+            self.load_newer()
+
+    def load_older(self):
+        if not self.pages:
+            return
+        rows = self.fetch("id < ?", (self.pages[-1][-1],))
+        if not rows:
+            return
+        loaded = sum(len(page) for page in self.pages)
+        self.insert(rows, None, self.top_number - loaded)
+        self.pages.append([row[0] for row in rows])
+        if len(self.pages) > self.max_pages:
+            dropped = self.pages.popleft()
+            self.tree.delete(*dropped)
+            self.top_number -= len(dropped)
+            self.tree.yview_scroll(-len(dropped), "units")
+
+    def load_newer(self):
+        if not self.pages:
+            return
+        rows = self.fetch("id > ?", (self.pages[0][0],), ascending=True)
+        if not rows:
+            return
+        self.top_number += len(rows)
+        self.insert(rows, 0, self.top_number)
+        self.pages.appendleft([row[0] for row in rows])
+        self.tree.yview_scroll(len(rows), "units")
+        if len(self.pages) > self.max_pages:
+            self.tree.delete(*self.pages.pop())
+
+    def remove(self, row_id):
+        # Drop one row; only the loaded rows above it change number
+        row_id = int(row_id)
+        above = self.tree.get_children()[:self.tree.index(row_id)]
+        self.tree.delete(row_id)
+        for page in self.pages:
+            if row_id in page:
+                page.remove(row_id)
+        self.discard_empty_pages()
+        for iid in above:
+            self.tree.set(iid, "No", int(self.tree.set(iid, "No")) - 1)
+        self.top_number -= 1
+        if not self.pages:
+            self.reload()
+
+    def refresh(self):
+        # Bring the loaded pages up to date in place: rows deleted elsewhere
+        # go, the next newer page comes in and changed numbers are rewritten
+        if not self.pages:
+            self.reload()
+            return
+        present = {row[0] for row in db.query(f"SELECT id FROM patients WHERE ({self.where}) AND id BETWEEN ? AND ?",
+                                              (*self.params, self.pages[-1][-1], self.pages[0][0]))}
+        for page in self.pages:
+            gone = [row_id for row_id in page if row_id not in present]
+            if gone:
+                self.tree.delete(*gone)
+                page[:] = [row_id for row_id in page if row_id in present]
+        self.discard_empty_pages()
+        if not self.pages:
+            self.reload()
+            return
+        self.top_number = self.number_of(self.pages[0][0])
+        self.load_newer()
+        for number, iid in zip(range(self.top_number, 0, -1), self.tree.get_children()):
+            if int(self.tree.set(iid, "No")) != number:
+                self.tree.set(iid, "No", number)
+
+    def discard_empty_pages(self):
+        self.pages = collections.deque(page for page in self.pages if page)
+
+class ReportCancelled(Exception):
+    pass
+
+# Set in each report worker process by init_report_worker
+report_progress = None
+report_cancelled = None
+
+def init_report_worker(progress, cancelled):
+    global report_progress, report_cancelled
+    report_progress, report_cancelled = progress, cancelled
+
+def report_stage(job_id, fraction, stage):
+    # Progress point of a report job; a cancelled job stops here
+    if report_cancelled[job_id % REPORT_JOB_SLOTS]:
+        raise ReportCancelled()
+    report_progress.put((job_id, fraction, stage))
+
+def setup_plot_axes(fig):
+    # Flow over volume, shared by the live plot and report figures
+    ax1 = fig.add_subplot(211)
+    ax2 = fig.add_subplot(212)
+    ax1.set_xlim(0,60)
+    ax2.set_xlim(0,60)
+    ax1.set_ylim(0,100)
+    ax2.set_ylim(0,300)
+    ax2.set_xlabel("Waktu (s)")
+    ax1.set_ylabel("Flowmeter")
+    ax2.set_ylabel("Volume")
+    ax1.grid(True, linestyle='--', alpha=0.7)
+    ax2.grid(True, linestyle='--', alpha=0.7)
+    return ax1, ax2
+
+class ReportFigure:
+    # Off-screen Agg figure in the live plot's layout, rendered to PNG bytes
+    # in memory. Axes and lines are built once; each report only swaps their
+    # data and limits.
+    def __init__(self):
+        self.fig = Figure(figsize=(7,4), dpi=100)
+        FigureCanvasAgg(self.fig)
+        self.ax1, self.ax2 = setup_plot_axes(self.fig)
+        self.line1, = self.ax1.plot([], [], 'r-')
+        self.line2, = self.ax2.plot([], [], 'b-')
+
+    def render(self, recording, dpi=REPORT_DPI):
+        # The whole recording, read from the pyramid level that fits the width
+        min_x = 0
+        max_x = max(PLOT_WINDOW_S, recording.end_time)
+        scale = dpi / self.fig.dpi
+        self.line1.set_data(*recording.envelope(1, min_x, max_x, int(self.ax1.bbox.width * scale)))
+        self.line2.set_data(*recording.envelope(2, min_x, max_x, int(self.ax2.bbox.width * scale)))
+        self.ax1.set_xlim(min_x, max_x)
+        self.ax2.set_xlim(min_x, max_x)
+        image = io.BytesIO()
+        self.fig.savefig(image, format="png", dpi=dpi)
+        image.seek(0)
+        return image
+
+idle_report_figures = []
+
+@contextlib.contextmanager
+def report_figure():
+    # Lend out an idle ReportFigure, creating one only when every existing
+    # figure is busy, so concurrent reports never share one
+    try:
+        figure = idle_report_figures.pop()
+    except IndexError:
+        figure = ReportFigure()
+    try:
+        yield figure
+    finally:
+        idle_report_figures.append(figure)
+
+def report_content(row_id):
+    # The CPU-heavy part of a report, done in a worker: patient fields,
+    # uroflow metrics and the plot as PNG bytes. Metrics and plot are None
+    # when the patient has no stored recording.
+    patient = db.query_one(
+        "SELECT p.first_name, p.last_name, p.patient_id, p.gender, p.age, p.date, p.time, h.name, d.name, h.address "
+        "FROM patients p LEFT JOIN hospitals h ON h.id = p.hospital_id LEFT JOIN doctors d ON d.id = p.doctor_id "
+        "WHERE p.id=?",
+        (row_id,))
+    recording = open_recording(row_id)
+    if recording is None:
+        return patient, None, None
+
+    metrics = recording_metrics(row_id)
+    with report_figure() as figure:
+        plot = figure.render(recording).getvalue()
+    return patient, metrics, plot
+
+def new_report_pdf():
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=10)
+    return pdf
+
+def layout_report(pdf, patient, metrics, plot):
+    pdf.add_page()
+
+    pdf.set_font("Arial", 'B', 16)
+    pdf.cell(0, 8, 'Patient Report', ln=1, align='C')
+
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 6, 'Hospital Information', ln=1)
+    pdf.set_font("Arial", '', 10)
+    if patient and patient[7]:
+        if patient[9]:
+            pdf.cell(0, 5, f"Name: {patient[7]}, Address: {patient[9]}", ln=1)
+        else:
+            pdf.cell(0, 5, f"Name: {patient[7]}", ln=1)
+    pdf.ln(2)
+
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 6, 'Patient Information', ln=1)
+    pdf.set_font("Arial", '', 10)
+    if patient:
+        pdf.cell(0, 5,
+                 f"ID: {patient[2]}, Name: {patient[0]} {patient[1]}, Gender: {patient[3]}, Age: {patient[4]}, Date: {patient[5]}, Time: {patient[6]}",
+                 ln=1)
+    pdf.ln(2)
+
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 6, 'Doctor Information', ln=1)
+    pdf.set_font("Arial", '', 10)
+    if patient and patient[8]:
+        pdf.cell(0, 5, f"Doctor: {patient[8]}", ln=1)
+    pdf.ln(2)
+
+    if metrics is None:
+        # no stored recording, skip plot and metrics
+        pdf.cell(0, 5, "No flow/volume data available.", ln=1)
+        return
+
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 6, 'Uroflowmetry Parameters', ln=1)
+    pdf.set_font("Arial", '', 10)
+    pdf.cell(0, 5, f"Maximum Flow Rate (Qmax): {metrics.qmax:.2f} ml/s", ln=1)
+    pdf.cell(0, 5, f"Average Flow Rate (Qave): {metrics.qave:.2f} ml/s", ln=1)
+    pdf.cell(0, 5, f"Voided Volume: {metrics.voided_volume:.1f} ml", ln=1)
+    pdf.cell(0, 5, f"Voiding Time: {metrics.voiding_time:.1f} seconds", ln=1)
+    pdf.cell(0, 5, f"Flow Time: {metrics.flow_time:.1f} seconds", ln=1)
+    pdf.cell(0, 5, f"Time to Maximum Flow Rate: {metrics.time_to_qmax:.1f} seconds", ln=1)
+    pdf.cell(0, 5, f"Flow Pattern: {metrics.pattern} ({metrics.segments} flow segment{'s' if metrics.segments != 1 else ''})", ln=1)
+    pdf.ln(2)
+
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 6, 'Flowmeter and Volume Plots', ln=1)
+    pdf.image(io.BytesIO(plot), x=10, w=pdf.w - 20)
+
+def write_pdf(pdf, pdf_filename):
+    # Written under a temporary name and renamed, so a cancelled or failed
+    # job never leaves a half-written report behind
+    pdf.output(pdf_filename + ".part")
+    os.replace(pdf_filename + ".part", pdf_filename)
+
+def build_report(job_id, row_id, pdf_filename):
+    # Runs in a report worker
+    report_stage(job_id, 0.0, "Rendering report")
+    content = report_content(row_id)
+    report_stage(job_id, 0.7, "Laying out PDF")
+    pdf = new_report_pdf()
+    layout_report(pdf, *content)
+    report_stage(job_id, 0.9, "Writing PDF")
+    write_pdf(pdf, pdf_filename)
+    return pdf_filename
+
+def batch_report_filename(row_id, patient):
+    name = f"{row_id}_{patient[2]}_{patient[0]}_{patient[1]}_report.pdf"
+    return re.sub(r'[^\w.-]+', '_', name)
+
+def render_report_contents(row_ids):
+    # Worker task of a combined export: contents only, laid out by the caller
+    return [report_content(row_id) for row_id in row_ids]
+
+def write_reports(row_ids, directory):
+    # Worker task of an individual export: one PDF per patient
+    filenames = []
+    for row_id in row_ids:
+        content = report_content(row_id)
+        pdf = new_report_pdf()
+        layout_report(pdf, *content)
+        filename = os.path.join(directory, batch_report_filename(row_id, content[0]))
+        write_pdf(pdf, filename)
+        filenames.append(filename)
+    return filenames
+
+def export_reports(executor, row_ids, output, combined=False, on_progress=None, cancel=None):
+    # Batch export across the executor's workers, REPORT_BATCH_CHUNK
+    # patients per task so each worker keeps its figure and connection
+    # between reports. Individual PDFs go into the output directory; a
+    # combined export is laid out here, in row_ids order, into the single
+    # PDF at output. on_progress(done, total) runs on the calling thread
+    # and a set cancel event raises ReportCancelled. Returns (count, seconds).
+    start = time.perf_counter()
+    chunks = [row_ids[i:i + REPORT_BATCH_CHUNK] for i in range(0, len(row_ids), REPORT_BATCH_CHUNK)]
+    if combined:
+        futures = [executor.submit(render_report_contents, chunk) for chunk in chunks]
+        pdf = new_report_pdf()
+    else:
+        os.makedirs(output, exist_ok=True)
+        futures = [executor.submit(write_reports, chunk, output) for chunk in chunks]
+    done = 0
+    try:
+        for future in futures:
+            results = future.result()
+            if cancel is not None and cancel.is_set():
+                raise ReportCancelled()
+            if combined:
+                for content in results:
+                    layout_report(pdf, *content)
+            done += len(results)
+            if on_progress:
+                on_progress(done, len(row_ids))
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    if combined and done:
+        write_pdf(pdf, output)
+    return done, time.perf_counter() - start
+
+def batch_row_ids(date_from=None, date_to=None, hospital_id=None, doctor_id=None, text=""):
+    where, params = patient_search_filter(text, date_from, date_to, hospital_id, doctor_id)
+    return [row[0] for row in db.query(f"SELECT id FROM patients WHERE {where} ORDER BY date, time, id", params)]
+
+class ReportPool:
+    # Builds PDF reports in worker processes (matplotlib Agg and FPDF are CPU
+    # bound) so the Tk thread keeps acquiring and drawing. Workers are
+    # spawned, not forked, because the serial reader thread is running.
+    # Progress goes through a queue drained by poll() on Tk's after loop.
+    # cancel() drops a queued job outright; a running one stops at its next
+    # report_stage().
+    def __init__(self, widget, workers=REPORT_WORKERS):
+        self.widget = widget
+        self.workers = workers
+        self.executor = None
+        self.jobs = {}  # job id -> (future, on_progress, on_done)
+        self.next_id = 0
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.progress = ctx.Queue()
+        self.cancelled = ctx.Array('b', REPORT_JOB_SLOTS, lock=False)
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=ctx, initializer=init_report_worker, initargs=(self.progress, self.cancelled))
+
+    def submit(self, row_id, pdf_filename, on_progress=None, on_done=None):
+        # on_progress(fraction, stage) and on_done(error) run on the Tk thread;
+        # error is None on success and ReportCancelled after cancel()
+        if self.executor is None:
+            self.start()
+        job_id = self.next_id
+        self.next_id += 1
+        self.cancelled[job_id % REPORT_JOB_SLOTS] = 0
+        future = self.executor.submit(build_report, job_id, row_id, pdf_filename)
+        self.jobs[job_id] = (future, on_progress, on_done)
+        if len(self.jobs) == 1:
+            self.widget.after(REPORT_POLL_MS, self.poll)
+        return job_id
+
+    def export(self, row_ids, output, combined=False, on_progress=None, on_done=None):
+        # Batch export on the same workers. export_reports blocks on its
+        # futures, so it runs on a thread and hands updates back through a
+        # queue polled from Tk. on_progress(done, total) and
+        # on_done(error, count, seconds) run on the Tk thread. Returns an
+        # event that cancels the export when set.
+        if self.executor is None:
+            self.start()
+        cancel = threading.Event()
+        updates = queue.Queue()
+
+        def run():
+            try:
+                count, seconds = export_reports(self.executor, row_ids, output, combined,
+                                                lambda done, total: updates.put((None, done, total)), cancel)
+                updates.put((True, None, (count, seconds)))
+            except BaseException as e:
+                updates.put((True, e, (0, 0.0)))
+
+        def poll():
+            while True:
+                try:
+                    finished, a, b = updates.get_nowait()
+                except queue.Empty:
+                    break
+                if finished:
+                    if on_done:
+                        on_done(a, *b)
+                    return
+                if on_progress:
+                    on_progress(a, b)
+            self.widget.after(REPORT_POLL_MS, poll)
+
+        threading.Thread(target=run, daemon=True).start()
+        self.widget.after(REPORT_POLL_MS, poll)
+        return cancel
+
+    def cancel(self, job_id):
+        if job_id in self.jobs:
+            self.cancelled[job_id % REPORT_JOB_SLOTS] = 1
+            self.jobs[job_id][0].cancel()
+
+    def poll(self):
+        while True:
+            try:
+                job_id, fraction, stage = self.progress.get_nowait()
+            except queue.Empty:
+                break
+            job = self.jobs.get(job_id)
+            if job and job[1]:
+                job[1](fraction, stage)
+        for job_id, (future, _, on_done) in list(self.jobs.items()):
+            if future.done():
+                del self.jobs[job_id]
+                error = ReportCancelled() if future.cancelled() else future.exception()
+                if on_done:
+                    on_done(error)
+        if self.jobs:
+            self.widget.after(REPORT_POLL_MS, self.poll)
+
+    def close(self):
+        if self.executor is not None:
+            for job_id in list(self.jobs):
+                self.cancel(job_id)
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+class ReportCache:
+    # Content-addressed store of built report PDFs. The key hashes the
+    # patients row (with its hospital and doctor), the recording checksum,
+    # REPORT_TEMPLATE_VERSION and METRICS_VERSION, so an edit, a new
+    # template or new metrics always miss and an unchanged report is served
+    # from disk. The report_cache
+    # table tracks size and last use; past REPORT_CACHE_MAX_BYTES or
+    # REPORT_CACHE_MAX_ENTRIES the least recently used reports are deleted.
+    def __init__(self, directory=REPORT_CACHE_DIR, max_bytes=REPORT_CACHE_MAX_BYTES,
+                 max_entries=REPORT_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+    def key(self, row_id):
+        row = db.query_one(
+            "SELECT p.id, p.patient_id, p.first_name, p.last_name, p.gender, p.age, p.date, p.time, "
+            "h.name, h.address, d.name, r.checksum "
+            "FROM patients p LEFT JOIN hospitals h ON h.id = p.hospital_id LEFT JOIN doctors d ON d.id = p.doctor_id "
+            "LEFT JOIN recordings r ON r.patient_row_id = p.id WHERE p.id=?",
+            (row_id,))
+        if row is None:
+            return None
+        return hashlib.sha256(repr((REPORT_TEMPLATE_VERSION, METRICS_VERSION, tuple(row))).encode()).hexdigest()
+
+    def path(self, key):
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f"{key}.pdf")
+
+    def get(self, key):
+        # Path of the cached report, or None; a hit counts as a use
+        path = self.path(key)
+        hit = db.execute("UPDATE report_cache SET last_used=? WHERE key=?", (time.time(), key)).rowcount
+        if hit and os.path.exists(path):
+            return path
+        if hit:
+            db.execute("DELETE FROM report_cache WHERE key=?", (key,))
+        return None
+
+    def put(self, key, row_id):
+        # Record a report just written to path(key), then evict
+        db.execute("INSERT OR REPLACE INTO report_cache (key, patient_row_id, size, last_used) VALUES (?, ?, ?, ?)",
+                   (key, row_id, os.path.getsize(self.path(key)), time.time()))
+        self.evict()
+
+    def purge(self, row_id):
+        # Delete every report built for a patient, current or outdated
+        with db.transaction() as c:
+            keys = [row[0] for row in c.execute("SELECT key FROM report_cache WHERE patient_row_id=?", (row_id,))]
+            c.execute("DELETE FROM report_cache WHERE patient_row_id=?", (row_id,))
+        self.remove_files(keys)
+
+    def evict(self):
+        evicted = []
+        with db.transaction() as c:
+            total, count = c.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM report_cache").fetchone()
+            if total <= self.max_bytes and count <= self.max_entries:
+                return
+            for key, size in c.execute("SELECT key, size FROM report_cache ORDER BY last_used").fetchall():
+                if total <= self.max_bytes and count <= self.max_entries:
+                    break
+                c.execute("DELETE FROM report_cache WHERE key=?", (key,))
+                evicted.append(key)
+                total -= size
+                count -= 1
+        self.remove_files(evicted)
+
+    def remove_files(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
 
 class App(ctk.CTk):
     def __init__(self):
@@ -175,9 +2412,12 @@ class App(ctk.CTk):
             frame.place(relx=0, rely=0, relwidth=1, relheight=1)
         self.current_page = StartPage
         self.show_start()
-        self.serial_thread = None
-        self.serial_stop_event = threading.Event()
+        self.link = SerialLink(COM_PORT, BAUDRATE)
+        self.reports = ReportPool(self)
+        self.report_cache = ReportCache()
+        self.streaming = False
         self.data_queue = queue.Queue()
+        self.render_scheduler = RenderScheduler(self, self.update_plot)
 
     def show_start(self):
         self.frames[StartPage].tkraise()
@@ -200,34 +2440,48 @@ class App(ctk.CTk):
             return
         self.stop_serial()
         self.frames[StartPage].clear_plot()
-        self.serial_stop_event.clear()
-        self.serial_thread = SerialReader(COM_PORT, BAUDRATE, self.data_queue, self.serial_stop_event)
-        self.serial_thread.start()
-        self.after(100, self.update_plot)
+        # Drop anything queued before this test started
+        self.data_queue = queue.Queue()
+        self.link.subscribe(self.data_queue)
+        self.streaming = True
+        self.frames[StartPage].blitter.start()
+        self.render_scheduler.start()
 
     def stop_serial(self):
-        if self.serial_thread:
-            self.serial_stop_event.set()
-            self.serial_thread = None
+        # The port stays open; only the live view stops listening
+        self.link.unsubscribe(self.data_queue)
+        self.streaming = False
+        self.frames[StartPage].blitter.stop()
 
     def clear_plot(self):
         self.frames[StartPage].clear_plot()
 
     def update_plot(self):
+        # Drain everything queued since the last frame, then render once
         frame = self.frames[StartPage]
-        while not self.data_queue.empty():
-            val = self.data_queue.get()
-            if val and len(val) == 2 and val[0] != 'error':
-                flow, volume = val
-                frame.add_data(flow, volume)
-            elif val and val[0] == 'error':
-                messagebox.showerror("Serial Error", f"Failed to open serial port: {val[1]}")
+        blocks = []
+        while True:
+            try:
+                kind, val = self.data_queue.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'samples':
+                blocks.append(val)
+            elif kind == 'error':
+                messagebox.showerror("Serial Error", f"Failed to open serial port: {val}")
+                self.stop_serial()
+        if blocks:
+            block = np.concatenate(blocks)
+            frame.add_samples(block[:, 0], block[:, 1], block[:, 2], block[:, 3])
+            if frame.flow_stopped():
                 self.stop_serial()
-        if self.serial_thread and not self.serial_stop_event.is_set():
-            self.after(100, self.update_plot)
+        frame.render()
+        frame.show_link_status(self.link.status_text())
+        return self.streaming
 
     def restart(self, windows_restart=False):
         self.stop_serial()
+        self.link.close()
         if windows_restart:
             if messagebox.askyesno("Restart Windows", "Yakin ingin restart Windows?"):
                 os.system("shutdown /r /t 0")
@@ -237,6 +2491,9 @@ class App(ctk.CTk):
 
     def on_close(self, shutdown_windows=False):
         self.stop_serial()
+        self.link.close()
+        self.reports.close()
+        db.close()
         if shutdown_windows:
             if messagebox.askyesno("Shutdown Windows", "Yakin ingin shutdown Windows?"):
                 os.system("shutdown /s /t 0")
@@ -245,42 +2502,45 @@ class App(ctk.CTk):
 
     def send_serial_data(self, data_bytes: bytes):
         # Helper method to send bytes to serial device if connected
-        if self.serial_thread and self.serial_thread.ser and self.serial_thread.ser.is_open:
-            try:
-                self.serial_thread.ser.write(data_bytes)
-            except Exception as e:
-                messagebox.showerror("Serial Error", f"Failed to send data to device: {e}")
+        if self.link.is_open:
+            self.run_command(data_bytes, None, lambda reply, error: error and messagebox.showerror(
+                "Serial Error", f"Failed to send data to device: {error}"))
         else:
             messagebox.showwarning("Serial Warning", "Serial port not connected or open.")
 
+    def run_command(self, command, ack, on_done):
+        # Send a command over the shared link and call on_done(reply, error)
+        # back on the Tk thread once the device has answered
+        future = self.link.send_command(command, ack)
+
+        def poll():
+            if not future.done():
+                self.after(20, poll)
+                return
+            try:
+                on_done(future.result(), None)
+            except Exception as e:
+                on_done(None, e)
+        poll()
+
 class StartPage(ctk.CTkFrame):
     def __init__(self, parent, controller):
         super().__init__(parent)
         self.controller = controller
 
-        self.flow_data = []
-        self.volume_data = []
+        self.window = SampleRingBuffer(WINDOW_CAPACITY)
+        self.recorder = SessionRecorder(columns=len(RECORDING_COLUMNS))
+        self.live_metrics = UroflowAccumulator()
 
         self.fig = Figure(figsize=(7,4), dpi=100)
-        self.ax1 = self.fig.add_subplot(211)
-        self.ax2 = self.fig.add_subplot(212)
-        self.ax1.set_xlim(0,60)
-        self.ax2.set_xlim(0,60)
-        self.ax1.set_ylim(0,100)
-        self.ax2.set_ylim(0,300)
-        self.ax2.set_xlabel("Waktu (s)")
-        self.ax1.set_ylabel("Flowmeter")
-        self.ax2.set_ylabel("Volume")
-        self.ax1.grid(True, linestyle='--', alpha=0.7)
-        self.ax2.grid(True, linestyle='--', alpha=0.7)
+        self.ax1, self.ax2 = setup_plot_axes(self.fig)
         self.line1, = self.ax1.plot([], [], 'r-')
         self.line2, = self.ax2.plot([], [], 'b-')
         self.canvas = FigureCanvasTkAgg(self.fig, master=self)
         self.canvas.get_tk_widget().pack(fill="both", expand=True, padx=20, pady=10)
-        self.xdata = []
-        self.ydata1 = []
-        self.ydata2 = []
+        self.blitter = BlitRenderer(self.canvas, (self.ax1, self.ax2), (self.line1, self.line2))
         self.start_time = None
+        self.dirty = False
 
         info = ctk.CTkFrame(self)
         info.pack(fill="x", padx=18, pady=8)
@@ -288,42 +2548,60 @@ class StartPage(ctk.CTkFrame):
         self.lbl_flow.pack(side="left", padx=10)
         self.lbl_vol = ctk.CTkLabel(info, text="Volume: 0", font=("Arial", 20))
         self.lbl_vol.pack(side="left", padx=10)
+        self.lbl_metrics = ctk.CTkLabel(info, text="", font=("Arial", 14))
+        self.lbl_metrics.pack(side="left", padx=10)
+        self.lbl_link = ctk.CTkLabel(info, text="", font=("Arial", 12), text_color="#666666")
+        self.lbl_link.pack(side="left", padx=10)
         ctk.CTkButton(info, text="💾 Save", font=("Arial", 14, "bold"), width=110, height=34, anchor="w", command=self.save_data).pack(side="right", padx=10)
         ctk.CTkButton(info, text="📄 Report", font=("Arial", 14, "bold"), width=110, height=34, anchor="w", command=self.report).pack(side="right", padx=10)
 
-    def add_data(self, flow, volume):
-        t = time.time()
+    def add_samples(self, stamps, flows, volumes, raws):
+        # Buffer a batch of samples stamped by the reader; artists are only
+        # touched in render()
         if not self.start_time:
-            self.start_time = t
-        elapsed = t - self.start_time
-        self.xdata.append(elapsed)
-        self.ydata1.append(flow)
-        self.ydata2.append(volume)
-
-        self.flow_data.append(flow)
-        self.volume_data.append(volume)
-
-        while self.xdata and self.xdata[0] < elapsed-60:
-            self.xdata.pop(0)
-            self.ydata1.pop(0)
-            self.ydata2.pop(0)
-            self.flow_data.pop(0)
-            self.volume_data.pop(0)
-        self.line1.set_data(self.xdata, self.ydata1)
-        self.line2.set_data(self.xdata, self.ydata2)
-        self.ax1.set_xlim(max(0, elapsed-60), max(60, elapsed))
-        self.ax2.set_xlim(max(0, elapsed-60), max(60, elapsed))
-        self.canvas.draw_idle()
-        self.lbl_flow.configure(text=f"Flowmeter: {flow}")
-        self.lbl_vol.configure(text=f"Volume: {volume}")
+            self.start_time = stamps[0]
+        times = stamps - self.start_time
+        self.recorder.extend(np.column_stack((times, flows, volumes, raws)))
+        self.live_metrics.extend(times, flows, volumes)
+        self.window.extend(times, flows, volumes)
+        self.window.evict_before(times[-1] - PLOT_WINDOW_S)
+        self.dirty = True
+
+    def render(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        elapsed, flow, volume = self.window.last()
+        self.set_line_data(self.window.times, self.window.flows, self.window.volumes)
+        # Scroll in whole tick steps so the cached background stays valid in between
+        max_x = max(PLOT_WINDOW_S, np.ceil(elapsed / X_TICK_STEP) * X_TICK_STEP)
+        self.blitter.set_xlim(max_x - PLOT_WINDOW_S, max_x)
+        self.blitter.update()
+        self.lbl_flow.configure(text=f"Flowmeter: {flow:.2f}")
+        self.lbl_vol.configure(text=f"Volume: {volume:.2f}")
+        text = metrics_text(self.live_metrics.snapshot())
+        if self.lbl_metrics.cget("text") != text:
+            self.lbl_metrics.configure(text=text)
+
+    def flow_stopped(self):
+        # True once a void has been seen and has been over for
+        # AUTO_STOP_NO_FLOW_S
+        return AUTO_STOP_NO_FLOW_S is not None and self.live_metrics.no_flow_for() >= AUTO_STOP_NO_FLOW_S
+
+    def set_line_data(self, times, flows, volumes):
+        # Never hand the lines more vertices than the axes have pixels for
+        self.line1.set_data(*minmax_decimate(times, flows, int(self.ax1.bbox.width)))
+        self.line2.set_data(*minmax_decimate(times, volumes, int(self.ax2.bbox.width)))
+
+    def show_link_status(self, text):
+        if self.lbl_link.cget("text") != text:
+            self.lbl_link.configure(text=text)
 
     def clear_plot(self):
-        self.xdata.clear()
-        self.ydata1.clear()
-        self.ydata2.clear()
-        self.flow_data.clear()
-        self.volume_data.clear()
+        self.window.clear(WINDOW_CAPACITY)
+        self.recorder.clear()
         self.start_time = None
+        self.dirty = False
         self.line1.set_data([], [])
         self.line2.set_data([], [])
         self.ax1.set_xlim(0,60)
@@ -331,6 +2609,8 @@ class StartPage(ctk.CTkFrame):
         self.canvas.draw_idle()
         self.lbl_flow.configure(text="Flowmeter: 0")
         self.lbl_vol.configure(text="Volume: 0")
+        self.lbl_metrics.configure(text="")
+        self.live_metrics.reset()
 
     def save_data(self):
         win = tk.Toplevel(self)
@@ -385,13 +2665,10 @@ class StartPage(ctk.CTkFrame):
         entry_time = tk.Entry(frame, textvariable=time_var, state="readonly")
         entry_time.grid(row=8, column=1, sticky="ew")
 
-        conn = sqlite3.connect('hospital_doctor.db')
-        c = conn.cursor()
-        c.execute("SELECT name FROM hospitals ORDER BY id")
-        hospitals = [row[0] for row in c.fetchall()]
-        c.execute("SELECT name FROM doctors ORDER BY id")
-        doctors = [row[0] for row in c.fetchall()]
-        conn.close()
+        hospital_rows = db.query("SELECT id, name FROM hospitals WHERE active=1 ORDER BY id")
+        doctor_rows = db.query("SELECT id, name FROM doctors WHERE active=1 ORDER BY id")
+        hospitals = [row[1] for row in hospital_rows]
+        doctors = [row[1] for row in doctor_rows]
 
         hospital_menu['values'] = hospitals
         doctor_menu['values'] = doctors
@@ -413,6 +2690,8 @@ class StartPage(ctk.CTkFrame):
             age = entry_age.get().strip()
             hospital = hospital_var.get()
             doctor = doctor_var.get()
+            hospital_id = hospital_rows[hospital_menu.current()][0] if hospital else None
+            doctor_id = doctor_rows[doctor_menu.current()][0] if doctor else None
             date = date_var.get()
             time_ = time_var.get()
 
@@ -424,20 +2703,11 @@ class StartPage(ctk.CTkFrame):
             except:
                 messagebox.showerror("Error", "Age must be a number!")
                 return
-            conn = sqlite3.connect('hospital_doctor.db')
-            c = conn.cursor()
-            c.execute("INSERT INTO patients (patient_id, first_name, last_name, gender, age, date, time, hospital_name, doctor_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                      (pid, first, last, gender, age_int, date, time_, hospital, doctor))
-            conn.commit()
-            conn.close()
-
-            # Save flow and volume data to CSV with patient_id, first and last name for unique filename
-            filename = f"{pid}_{first}_{last}_data.csv"
-            with open(filename, mode='w', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow(["Time (s)", "Flow", "Volume"])
-                for i in range(len(self.xdata)):
-                    writer.writerow([self.xdata[i], self.ydata1[i], self.ydata2[i]])
+            # The whole session (not just the plot window) is stored with the patient row
+            with db.transaction() as c:
+                cur = c.execute("INSERT INTO patients (patient_id, first_name, last_name, gender, age, date, time, hospital_id, doctor_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (pid, first, last, gender, age_int, date, time_, hospital_id, doctor_id))
+                save_recording(c, cur.lastrowid, *self.recorder.columns_data())
 
             messagebox.showinfo("Success", "Patient data saved!")
             win.destroy()
@@ -449,74 +2719,18 @@ class StartPage(ctk.CTkFrame):
             frame.grid_rowconfigure(i, pad=8)
         frame.grid_columnconfigure(1, weight=1)
 
-    def load_patient_data(self, patient_id):
-        self.xdata.clear()
-        self.ydata1.clear()
-        self.ydata2.clear()
-        self.flow_data.clear()
-        self.volume_data.clear()
-        self.start_time = None
-
-        try:
-            filename = None
-            # Find matching CSV file based on patient_id, first name, last name if needed
-            # Here we try to find any CSV file starting with patient_id_
-            # This assumes files are saved as "{pid}_{first}_{last}_data.csv"
-            files = [f for f in os.listdir('.') if f.endswith('_data.csv') and f.startswith(f"{patient_id}_")]
-            if files:
-                filename = files[0]
-            else:
-                # fallback: try {patient_id}_data.csv
-                fallback = f"{patient_id}_data.csv"
-                if os.path.exists(fallback):
-                    filename = fallback
-
-            if filename is None:
-                raise FileNotFoundError()
-
-            with open(filename, mode='r') as file:
-                reader = csv.reader(file)
-                next(reader)
-                for row in reader:
-                    time_val, flow, volume = map(float, row)
-                    self.xdata.append(time_val)
-                    self.ydata1.append(flow)
-                    self.ydata2.append(volume)
-                    self.flow_data.append(flow)
-                    self.volume_data.append(volume)
-            if self.xdata:
-                self.start_time = time.time() - self.xdata[-1]
-
-            self.line1.set_data(self.xdata, self.ydata1)
-            self.line2.set_data(self.xdata, self.ydata2)
-            if self.xdata:
-                min_x = max(0, self.xdata[-1] - 60)
-                max_x = max(60, self.xdata[-1])
-            else:
-                min_x, max_x = 0, 60
-            self.ax1.set_xlim(min_x, max_x)
-            self.ax2.set_xlim(min_x, max_x)
-            self.canvas.draw_idle()
-
-            if self.ydata1:
-                self.lbl_flow.configure(text=f"Flowmeter: {self.ydata1[-1]:.2f}")
-            else:
-                self.lbl_flow.configure(text="Flowmeter: 0")
-            if self.ydata2:
-                self.lbl_vol.configure(text=f"Volume: {self.ydata2[-1]:.2f}")
-            else:
-                self.lbl_vol.configure(text="Volume: 0")
-
-        except FileNotFoundError:
-            print(f"No data file found for patient {patient_id}.")
-            self.clear_plot()
-
     def report(self):
         win = tk.Toplevel(self)
         win.title("Patient Report")
-        win.geometry("700x400")
+        win.geometry("760x480")
         win.grab_set()
 
+        def clear_preview():
+            # The start page plot doubles as the preview, except during a
+            # test: its recorder holds the unsaved session
+            if not self.controller.streaming:
+                self.clear_plot()
+
         frame_hist = tk.Frame(win)
         frame_hist.pack(fill="both", expand=True, padx=10, pady=10)
 
@@ -531,120 +2745,264 @@ class StartPage(ctk.CTkFrame):
         tree.pack(side="left", fill="both", expand=True)
         sb = tk.Scrollbar(frame_hist, orient="vertical", command=tree.yview)
         sb.pack(side="right", fill="y")
-        tree.config(yscrollcommand=sb.set)
-
-        def load_data():
-            for item in tree.get_children():
-                tree.delete(item)
-            conn = sqlite3.connect('hospital_doctor.db')
-            c = conn.cursor()
-            c.execute("SELECT id, patient_id, first_name, last_name, date, time FROM patients ORDER BY id DESC")
-            rows = c.fetchall()
-
-            total = len(rows)
-            for idx, (db_id, patient_id, first, last, date, time_) in enumerate(rows):
-                display_num = total - idx  # Inverted numbering: 1 at bottom, highest at top
-                tree.insert("", "end", iid=db_id, values=(display_num, f"{first} {last}", date, time_))
-
-            # conn.close()
-            # for idx, (db_id, patient_id, first, last, date, time_) in enumerate(rows, start=1):
-            #     tree.insert("", "end", iid=db_id, values=(idx, f"{first} {last}", date, time_))
-
-            self.clear_plot()
-
-        load_data()
-
-        def on_patient_select():
+        history = PatientHistory(tree)
+
+        def on_tree_scroll(first, last):
+            sb.set(first, last)
+            history.on_scroll(first, last)
+
+        tree.config(yscrollcommand=on_tree_scroll)
+
+        history.reload()
+        clear_preview()
+
+        frame_search = tk.Frame(win)
+        frame_search.pack(fill="x", padx=10, pady=(10, 0), before=frame_hist)
+        search_var = tk.StringVar()
+        from_var = tk.StringVar()
+        to_var = tk.StringVar()
+        hospital_rows = db.query("SELECT id, name FROM hospitals ORDER BY name")
+        doctor_rows = db.query("SELECT id, name FROM doctors ORDER BY name")
+
+        tk.Label(frame_search, text="Search").pack(side="left")
+        tk.Entry(frame_search, textvariable=search_var, width=18).pack(side="left", padx=(2, 8))
+        tk.Label(frame_search, text="From").pack(side="left")
+        tk.Entry(frame_search, textvariable=from_var, width=10).pack(side="left", padx=(2, 4))
+        tk.Label(frame_search, text="To").pack(side="left")
+        tk.Entry(frame_search, textvariable=to_var, width=10).pack(side="left", padx=(2, 8))
+        hospital_cb = ttk.Combobox(frame_search, values=["All hospitals"] + [name for _, name in hospital_rows],
+                                   state="readonly", width=16)
+        hospital_cb.current(0)
+        hospital_cb.pack(side="left", padx=(0, 4))
+        doctor_cb = ttk.Combobox(frame_search, values=["All doctors"] + [name for _, name in doctor_rows],
+                                 state="readonly", width=16)
+        doctor_cb.current(0)
+        doctor_cb.pack(side="left")
+
+        def iso_date(value):
+            # Half-typed dates (yyyy-mm-dd) are ignored until they parse
+            try:
+                return datetime.date.fromisoformat(value.strip()).isoformat()
+            except ValueError:
+                return None
+
+        search_job = None
+
+        def search_args():
+            h, d = hospital_cb.current(), doctor_cb.current()
+            return (search_var.get(), iso_date(from_var.get()), iso_date(to_var.get()),
+                    hospital_rows[h - 1][0] if h > 0 else None,
+                    doctor_rows[d - 1][0] if d > 0 else None)
+
+        def run_search():
+            nonlocal search_job
+            search_job = None
+            history.search(*patient_search_filter(*search_args()))
+            clear_preview()
+
+        def schedule_search(*_):
+            # Search once typing pauses rather than on every keystroke
+            nonlocal search_job
+            if search_job is not None:
+                win.after_cancel(search_job)
+            search_job = win.after(250, run_search)
+
+        for var in (search_var, from_var, to_var):
+            var.trace_add("write", schedule_search)
+        hospital_cb.bind("<<ComboboxSelected>>", schedule_search)
+        doctor_cb.bind("<<ComboboxSelected>>", schedule_search)
+
+        # Re-analysis of the selected recording; the PDF reports keep the
+        # analysis as recorded
+        frame_analysis = tk.Frame(win)
+        frame_analysis.pack(fill="x", padx=10, pady=(0, 6))
+        flow_var = tk.StringVar(value="As recorded")
+        diff_var = tk.StringVar(value="Savitzky-Golay")
+        median_var = tk.BooleanVar(value=True)
+        factor_var = tk.StringVar()
+
+        tk.Label(frame_analysis, text="Flow").pack(side="left")
+        ttk.Combobox(frame_analysis, textvariable=flow_var, values=["As recorded", "Host filter"],
+                     state="readonly", width=12).pack(side="left", padx=(2, 8))
+        ttk.Combobox(frame_analysis, textvariable=diff_var, values=["Savitzky-Golay", "Butterworth"],
+                     state="readonly", width=14).pack(side="left", padx=(0, 8))
+        tk.Checkbutton(frame_analysis, text="Spike filter", variable=median_var).pack(side="left", padx=(0, 8))
+        tk.Label(frame_analysis, text="Calibration factor").pack(side="left")
+        tk.Entry(frame_analysis, textvariable=factor_var, width=10).pack(side="left", padx=(2, 8))
+        lbl_analysis = tk.Label(frame_analysis, text="", anchor="w", fg="#666666")
+        lbl_analysis.pack(side="left", fill="x", expand=True)
+
+        def analysis_config():
+            # None for the analysis as recorded. A calibration factor means
+            # volume from the raw counts; it is ignored until it parses.
+            try:
+                factor = float(factor_var.get())
+            except ValueError:
+                factor = 0.0
+            if flow_var.get() == "As recorded" and factor <= 0:
+                return None
+            return HOST_FILTER._replace(
+                source="raw" if factor > 0 else "weight",
+                median=HOST_FILTER.median if median_var.get() else 1,
+                differentiator="butterworth" if diff_var.get() == "Butterworth" else "savgol",
+                raw_offset=None,
+                raw_scale=factor if factor > 0 else HOST_FILTER.raw_scale)
+
+        def on_patient_select(event=None):
             selected = tree.selection()
-            if selected:
-                db_id = selected[0]
-                conn = sqlite3.connect('hospital_doctor.db')
-                c = conn.cursor()
-                c.execute("SELECT patient_id, first_name, last_name FROM patients WHERE id=?", (db_id,))
-                result = c.fetchone()
-                conn.close()
-                if result:
-                    patient_id_str, first_name, last_name = result
-                    # Load plot data from CSV file named as patient_id_first_last_data.csv
-                    filename = f"{patient_id_str}_{first_name}_{last_name}_data.csv"
-                    if os.path.exists(filename):
-                        try:
-                            self.load_specific_csv(filename)
-                        except Exception as e:
-                            print("Error loading CSV file:", e)
-                            self.clear_plot()
-                    else:
-                        # fallback to load patient_id only CSV
-                        self.load_patient_data(patient_id_str)
-                else:
-                    self.clear_plot()
+            lbl_analysis.config(text="")
+            if not selected:
+                clear_preview()
+                return
+            try:
+                recording, metrics = reanalyzed_recording(selected[0], analysis_config())
+            except ValueError as e:
+                lbl_analysis.config(text=str(e))
+                recording, metrics = reanalyzed_recording(selected[0])
+            if self.controller.streaming:
+                # Only the metrics, on the label; the live plot keeps running
+                if metrics is not None:
+                    lbl_analysis.config(text=metrics_text(metrics))
+            elif recording is not None:
+                self.show_recording(recording, metrics)
             else:
-                self.clear_plot()
+                clear_preview()
 
         tree.bind("<<TreeviewSelect>>", on_patient_select)
+        for var in (flow_var, diff_var, median_var, factor_var):
+            var.trace_add("write", lambda *_: on_patient_select())
 
         frame_btn = tk.Frame(win)
         frame_btn.pack(fill="x", padx=10, pady=(0, 10))
 
+        report_jobs = set()
+        lbl_report = tk.Label(frame_btn, text="", anchor="e", fg="#666666")
+
+        building = {}  # cache key -> callbacks waiting for that report
+
+        def build_pdf(pid, then):
+            # then(pdf_filename) runs with the cached report, straight away on
+            # a hit or once a background build has written it
+            cache = self.controller.report_cache
+            key = cache.key(pid)
+            if key is None:
+                return
+            cached = cache.get(key)
+            if cached:
+                then(cached)
+                return
+            if key in building:
+                building[key].append(then)
+                return
+            building[key] = [then]
+
+            def on_progress(fraction, stage):
+                if lbl_report.winfo_exists():
+                    lbl_report.config(text=f"{stage}... {fraction:.0%}")
+
+            def on_done(error):
+                report_jobs.discard(job_id)
+                waiting = building.pop(key)
+                if lbl_report.winfo_exists():
+                    lbl_report.config(text="")
+                if isinstance(error, ReportCancelled):
+                    return
+                if error is not None:
+                    messagebox.showerror("Error", f"Failed to generate PDF: {error}")
+                    return
+                cache.put(key, pid)
+                for callback in waiting:
+                    callback(cache.path(key))
+
+            job_id = self.controller.reports.submit(pid, cache.path(key), on_progress, on_done)
+            report_jobs.add(job_id)
+
+        def cancel_reports():
+            for job_id in list(report_jobs):
+                self.controller.reports.cancel(job_id)
+            for cancel in list(batch_exports):
+                cancel.set()
+
+        batch_exports = []
+
+        def batch_export():
+            # Exports every patient matching the search row, oldest first
+            text, date_from, date_to, hospital_id, doctor_id = search_args()
+            row_ids = batch_row_ids(date_from, date_to, hospital_id, doctor_id, text)
+            if not row_ids:
+                messagebox.showwarning("Batch Export", "No patients match the current search.", parent=win)
+                return
+            combined = messagebox.askyesnocancel(
+                "Batch Export", f"Export {len(row_ids)} reports.\n\nCombine them into one PDF?", parent=win)
+            if combined is None:
+                return
+            if combined:
+                output = filedialog.asksaveasfilename(parent=win, defaultextension=".pdf",
+                                                      filetypes=[("PDF", "*.pdf")], initialfile="reports.pdf")
+            else:
+                output = filedialog.askdirectory(parent=win, mustexist=False)
+            if not output:
+                return
+
+            def on_progress(done, total):
+                if lbl_report.winfo_exists():
+                    lbl_report.config(text=f"Exporting {done}/{total}...")
+
+            def on_done(error, count, seconds):
+                batch_exports.remove(cancel)
+                if lbl_report.winfo_exists():
+                    lbl_report.config(text="")
+                if isinstance(error, ReportCancelled):
+                    return
+                if error is not None:
+                    messagebox.showerror("Error", f"Batch export failed: {error}")
+                    return
+                messagebox.showinfo("Batch Export", f"Exported {count} reports in {seconds:.1f} s "
+                                                    f"({count / max(seconds, 1e-9):.1f} reports/s).")
+
+            cancel = self.controller.reports.export(row_ids, output, combined, on_progress, on_done)
+            batch_exports.append(cancel)
+
+        def open_pdf(pdf_filename):
+            try:
+                if sys.platform == "win32":
+                    os.startfile(pdf_filename)
+                elif sys.platform == "darwin":
+                    os.system(f"open '{pdf_filename}'")
+                else:
+                    os.system(f"xdg-open '{pdf_filename}'")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to open PDF: {e}")
+
         def generate_pdf_and_open():
             sel = tree.selection()
             if not sel:
                 messagebox.showwarning("Warning", "Select a patient first!")
                 return
-            pid = sel[0]
-            conn = sqlite3.connect('hospital_doctor.db')
-            c = conn.cursor()
-            c.execute("SELECT first_name, last_name, patient_id FROM patients WHERE id=?", (pid,))
-            patient = c.fetchone()
-            conn.close()
-            if patient:
-                first_name, last_name, patient_id_str = patient
-                pdf_filename = f"{first_name}_{last_name}_report.pdf"
-                try:
-                    self.generate_pdf(patient_id_str, first_name, last_name, pdf_filename)
-                    if sys.platform == "win32":
-                        os.startfile(pdf_filename)
-                    elif sys.platform == "darwin":
-                        os.system(f"open '{pdf_filename}'")
-                    else:
-                        os.system(f"xdg-open '{pdf_filename}'")
-                except Exception as e:
-                    messagebox.showerror("Error", f"Failed to generate or open PDF: {e}")
+            build_pdf(sel[0], open_pdf)
 
         def print_pdf():
-            import subprocess
-
             sel = tree.selection()
             if not sel:
                 messagebox.showwarning("Warning", "Select a patient first!")
                 return
-            pid = sel[0]
-            conn = sqlite3.connect('hospital_doctor.db')
-            c = conn.cursor()
-            c.execute("SELECT first_name, last_name, patient_id FROM patients WHERE id=?", (pid,))
-            patient = c.fetchone()
-            conn.close()
-            if patient:
-                first_name, last_name, patient_id_str = patient
-                pdf_filename = f"{first_name}_{last_name}_report.pdf"
-                if not os.path.exists(pdf_filename):
-                    try:
-                        self.generate_pdf(patient_id_str, first_name, last_name, pdf_filename)
-                    except Exception as e:
-                        messagebox.showerror("Error", f"Failed to generate PDF: {e}")
-                        return
-                try:
-                    acrobat_path = r"C:\Program Files\Adobe\Acrobat DC\Acrobat\Acrobat.exe"
-                    if not os.path.exists(acrobat_path):
-                        messagebox.showerror("Error",
-                                             f"Adobe Acrobat not found at:\n{acrobat_path}\nSilakan cek lokasi instalasi Adobe Acrobat.")
-                        return
-
-                    cmd = f'"{acrobat_path}" /t "{os.path.abspath(pdf_filename)}"'
-                    subprocess.Popen(cmd, shell=True)
-                    messagebox.showinfo("Print PDF", "PDF sent to printer. Anda bisa cek printer queue.")
-                except Exception as e:
-                    messagebox.showerror("Error", f"Failed to print PDF: {e}")
+            build_pdf(sel[0], send_to_printer)
+
+        def send_to_printer(pdf_filename):
+            import subprocess
+
+            try:
+                acrobat_path = r"C:\Program Files\Adobe\Acrobat DC\Acrobat\Acrobat.exe"
+                if not os.path.exists(acrobat_path):
+                    messagebox.showerror("Error",
+                                         f"Adobe Acrobat not found at:\n{acrobat_path}\nSilakan cek lokasi instalasi Adobe Acrobat.")
+                    return
+
+                cmd = f'"{acrobat_path}" /t "{os.path.abspath(pdf_filename)}"'
+                subprocess.Popen(cmd, shell=True)
+                messagebox.showinfo("Print PDF", "PDF sent to printer. Anda bisa cek printer queue.")
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to print PDF: {e}")
 
         def delete_patient():
             sel = tree.selection()
@@ -653,17 +3011,20 @@ class StartPage(ctk.CTkFrame):
                 return
             pid = sel[0]
             if messagebox.askyesno("Delete", "Are you sure to delete this patient?"):
-                conn = sqlite3.connect('hospital_doctor.db')
-                c = conn.cursor()
-                c.execute("DELETE FROM patients WHERE id=?", (pid,))
-                conn.commit()
-                conn.close()
-                load_data()
-                self.clear_plot()
+                stored = db.query_one("SELECT path FROM recordings WHERE patient_row_id=?", (pid,))
+                db.execute("DELETE FROM patients WHERE id=?", (pid,))
+                self.controller.report_cache.purge(pid)
+                if stored and stored[0]:
+                    try:
+                        os.remove(stored[0])
+                    except OSError as e:
+                        print(f"Could not remove recording file {stored[0]}: {e}")
+                history.remove(pid)
+                clear_preview()
 
         def refresh():
-            load_data()
-            self.clear_plot()
+            history.refresh()
+            clear_preview()
 
         btn_view = tk.Button(frame_btn, text="View PDF", command=generate_pdf_and_open, width=12, bg="#0078D7",
                              fg="white", font=("Arial", 11, "bold"))
@@ -677,166 +3038,41 @@ class StartPage(ctk.CTkFrame):
         btn_refresh = tk.Button(frame_btn, text="Refresh", command=refresh, width=12, bg="#0078D7", fg="white",
                                 font=("Arial", 11, "bold"))
         btn_refresh.pack(side="left", padx=5)
-
-    def load_specific_csv(self, filename):
-        self.xdata.clear()
-        self.ydata1.clear()
-        self.ydata2.clear()
-        self.flow_data.clear()
-        self.volume_data.clear()
+        btn_batch = tk.Button(frame_btn, text="Batch Export", command=batch_export, width=12, bg="#0078D7",
+                              fg="white", font=("Arial", 11, "bold"))
+        btn_batch.pack(side="left", padx=5)
+        btn_cancel = tk.Button(frame_btn, text="Cancel", command=cancel_reports, width=8, font=("Arial", 11))
+        btn_cancel.pack(side="right", padx=5)
+        lbl_report.pack(side="right", fill="x", expand=True)
+
+    def show_recording(self, recording, metrics):
+        self.blitter.stop()
+        self.window.clear()
+        self.recorder.clear()
+        self.live_metrics.reset()
         self.start_time = None
 
-        with open(filename, mode='r') as file:
-            reader = csv.reader(file)
-            next(reader)
-            for row in reader:
-                time_val, flow, volume = map(float, row)
-                self.xdata.append(time_val)
-                self.ydata1.append(flow)
-                self.ydata2.append(volume)
-                self.flow_data.append(flow)
-                self.volume_data.append(volume)
-        if self.xdata:
-            self.start_time = time.time() - self.xdata[-1]
-
-        self.line1.set_data(self.xdata, self.ydata1)
-        self.line2.set_data(self.xdata, self.ydata2)
-        if self.xdata:
-            min_x = max(0, self.xdata[-1] - 60)
-            max_x = max(60, self.xdata[-1])
-        else:
-            min_x, max_x = 0, 60
-        self.ax1.set_xlim(min_x, max_x)
-        self.ax2.set_xlim(min_x, max_x)
+        self.plot_recording(recording)
         self.canvas.draw_idle()
 
-        if self.ydata1:
-            self.lbl_flow.configure(text=f"Flowmeter: {self.ydata1[-1]:.2f}")
+        if len(recording):
+            _, flow, volume, _ = recording.last()
+            self.lbl_flow.configure(text=f"Flowmeter: {flow:.2f}")
+            self.lbl_vol.configure(text=f"Volume: {volume:.2f}")
         else:
             self.lbl_flow.configure(text="Flowmeter: 0")
-        if self.ydata2:
-            self.lbl_vol.configure(text=f"Volume: {self.ydata2[-1]:.2f}")
-        else:
             self.lbl_vol.configure(text="Volume: 0")
-
-    def generate_pdf(self, patient_id, first_name, last_name, pdf_filename):
-        pdf = FPDF()
-        pdf.set_auto_page_break(auto=True, margin=10)
-        pdf.add_page()
-
-        pdf.set_font("Arial", 'B', 16)
-        pdf.cell(0, 8, 'Patient Report', ln=1, align='C')
-
-        conn = sqlite3.connect('hospital_doctor.db')
-        c = conn.cursor()
-        c.execute(
-            "SELECT first_name, last_name, patient_id, gender, age, date, time, hospital_name, doctor_name FROM patients WHERE id=(SELECT id FROM patients WHERE patient_id=? LIMIT 1)",
-            (patient_id,))
-        patient = c.fetchone()
-
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 6, 'Hospital Information', ln=1)
-        pdf.set_font("Arial", '', 10)
-        if patient and patient[7]:
-            c.execute("SELECT address FROM hospitals WHERE name=?", (patient[7],))
-            hosp_addr = c.fetchone()
-            if hosp_addr:
-                pdf.cell(0, 5, f"Name: {patient[7]}, Address: {hosp_addr[0]}", ln=1)
-            else:
-                pdf.cell(0, 5, f"Name: {patient[7]}", ln=1)
-        pdf.ln(2)
-
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 6, 'Patient Information', ln=1)
-        pdf.set_font("Arial", '', 10)
-        if patient:
-            pdf.cell(0, 5,
-                     f"ID: {patient[2]}, Name: {patient[0]} {patient[1]}, Gender: {patient[3]}, Age: {patient[4]}, Date: {patient[5]}, Time: {patient[6]}",
-                     ln=1)
-        pdf.ln(2)
-
-        pdf.set_font("Arial", 'B', 12)
-        pdf.cell(0, 6, 'Doctor Information', ln=1)
-        pdf.set_font("Arial", '', 10)
-        if patient and patient[8]:
-            pdf.cell(0, 5, f"Doctor: {patient[8]}", ln=1)
-        pdf.ln(2)
-
-        # Clear previous data
-        self.xdata.clear()
-        self.ydata1.clear()
-        self.ydata2.clear()
-        self.flow_data.clear()
-        self.volume_data.clear()
-        self.start_time = None
-
-        # Load data from CSV file by patient_id, first_name, last_name
-        data_filename = f"{patient_id}_{first_name}_{last_name}_data.csv"
-        if not os.path.exists(data_filename):
-            # fallback to older format
-            data_filename = f"{patient_id}_data.csv"
-            if not os.path.exists(data_filename):
-                # no data file, skip plot and stats
-                max_flow = avg_flow = time_to_max_flow = last_volume = 0
-                pdf.cell(0, 5, "No flow/volume data available.", ln=1)
-        if os.path.exists(data_filename):
-            with open(data_filename, mode='r') as file:
-                reader = csv.reader(file)
-                next(reader)
-                for row in reader:
-                    time_val, flow, volume = map(float, row)
-                    self.xdata.append(time_val)
-                    self.ydata1.append(flow)
-                    self.ydata2.append(volume)
-                    self.flow_data.append(flow)
-                    self.volume_data.append(volume)
-
-            if self.flow_data:
-                max_flow = max(self.flow_data)
-                avg_flow = sum(self.flow_data)/len(self.flow_data)
-                try:
-                    time_to_max_flow = self.xdata[self.flow_data.index(max_flow)] if max_flow in self.flow_data else 0
-                except Exception:
-                    time_to_max_flow = 0
-                last_volume = self.volume_data[-1] if self.volume_data else 0
-            else:
-                max_flow = avg_flow = time_to_max_flow = last_volume = 0
-
-            # Update figure with loaded data to have plot ready for saving image
-            self.line1.set_data(self.xdata, self.ydata1)
-            self.line2.set_data(self.xdata, self.ydata2)
-            if self.xdata:
-                min_x = max(0, self.xdata[-1] - 60)
-                max_x = max(60, self.xdata[-1])
-            else:
-                min_x, max_x = 0, 60
-            self.ax1.set_xlim(min_x, max_x)
-            self.ax2.set_xlim(min_x, max_x)
-            self.canvas.draw()
-
-            pdf.set_font("Arial", 'B', 12)
-            pdf.cell(0, 6, 'Flow and Volume Statistics', ln=1)
-            pdf.set_font("Arial", '', 10)
-            pdf.cell(0, 5, f"Maximum Flow Rate: {max_flow:.2f}", ln=1)
-            pdf.cell(0, 5, f"Average Flow Rate: {avg_flow:.2f}", ln=1)
-            pdf.cell(0, 5, f"Time to Maximum Flow Rate: {time_to_max_flow:.2f} seconds", ln=1)
-            pdf.cell(0, 5, f"Last Volume Data: {last_volume:.2f}", ln=1)
-            pdf.ln(2)
-
-            flow_plot_path = "flowmeter_plot.png"
-            self.fig.savefig(flow_plot_path, dpi=150)
-
-            pdf.set_font("Arial", 'B', 12)
-            pdf.cell(0, 6, 'Flowmeter and Volume Plots', ln=1)
-            pdf.image(flow_plot_path, x=10, w=pdf.w - 20)
-
-            if os.path.exists(flow_plot_path):
-                try:
-                    os.remove(flow_plot_path)
-                except Exception:
-                    pass
-
-        pdf.output(pdf_filename)
+        self.lbl_metrics.configure(text=metrics_text(metrics))
+
+    def plot_recording(self, recording):
+        # The whole recording, from the pyramid level that matches the axes'
+        # pixel width, so a long session costs no more than a short one
+        min_x = 0
+        max_x = max(PLOT_WINDOW_S, recording.end_time)
+        self.line1.set_data(*recording.envelope(1, min_x, max_x, int(self.ax1.bbox.width)))
+        self.line2.set_data(*recording.envelope(2, min_x, max_x, int(self.ax2.bbox.width)))
+        self.ax1.set_xlim(min_x, max_x)
+        self.ax2.set_xlim(min_x, max_x)
 
 class CalibrationPage(ctk.CTkFrame):
     def __init__(self, parent, controller):
@@ -897,16 +3133,43 @@ class CalibrationPage(ctk.CTkFrame):
         self.btn_send_values = ctk.CTkButton(self.frame2, text="Send", font=ctk.CTkFont(size=14, weight="bold"), width=160, command=self.send_calibration_values)
         self.btn_send_values.pack(pady=(30,12))
 
+        # Multi-point calibration on the host: raw counts captured at known
+        # weights, fitted and stored as the connected board's profile
+        self.lbl_title3 = ctk.CTkLabel(self.frame2, text="Multi-point Calibration", font=ctk.CTkFont(size=16, weight="bold"), text_color="#222222")
+        self.lbl_title3.pack(pady=(12,8))
+
+        capture_frame = ctk.CTkFrame(self.frame2, fg_color="#f0f0f0", corner_radius=6)
+        capture_frame.pack(fill="x", pady=4, padx=12)
+        ctk.CTkLabel(capture_frame, text="Reference weight (g):", font=ctk.CTkFont(size=14)).pack(side="left", padx=12, pady=10)
+        self.entry_reference = ctk.CTkEntry(capture_frame, placeholder_text="e.g. 500", width=90)
+        self.entry_reference.pack(side="left", padx=8, pady=10)
+        self.btn_capture = ctk.CTkButton(capture_frame, text="Capture", width=90, command=self.capture_point)
+        self.btn_capture.pack(side="left", padx=8, pady=10)
+
+        self.lbl_points = ctk.CTkLabel(self.frame2, text="No points captured", font=ctk.CTkFont(size=13), text_color="#444444", justify="left")
+        self.lbl_points.pack(pady=4, padx=12, anchor="w")
+
+        fit_frame = ctk.CTkFrame(self.frame2, fg_color="#ffffff")
+        fit_frame.pack(fill="x", pady=4, padx=12)
+        self.option_degree = ctk.CTkOptionMenu(fit_frame, values=list(CALIBRATION_DEGREES), width=110)
+        self.option_degree.pack(side="left", padx=(0,8))
+        ctk.CTkButton(fit_frame, text="Fit & Save", width=100, command=self.save_profile).pack(side="left", padx=4)
+        ctk.CTkButton(fit_frame, text="Clear", width=70, command=self.clear_points).pack(side="left", padx=4)
+
         # Data holders updated by the controller app on update or refresh
         self.current_flow = 0.0
         self.current_volume = 0.0
         self.current_tar = 0.0
 
-        # Tambahkan variabel untuk thread dan queue
-        self.calib_serial_thread = None
-        self.calib_serial_stop_event = threading.Event()
+        # Queue untuk data live dari koneksi serial bersama
+        self.calib_streaming = False
         self.calib_data_queue = queue.Queue()
 
+        self.points = []  # [raw counts, grams]
+        self.capture_grams = None
+        self.capture_raws = []
+        self.capture_job = None
+
     def refresh_data_calibration(self):
         # If needed, update displayed values here, a place-holder implementation
         self.update_labels(0.0, 0.0, 0.0)
@@ -919,15 +3182,14 @@ class CalibrationPage(ctk.CTkFrame):
         # self.lbl_tar.configure(text=f"TAR: {tar:.2f}")
 
     def zero_tar_clicked(self):
-        # Kirim string "T" ke Arduino via serial, buka dan tutup port secara langsung
-        # import serial  # pastikan pyserial sudah di-import di atas
-        try:
-            ser = serial.Serial(COM_PORT, BAUDRATE, timeout=1)
-            ser.write(b"T")
-            ser.close()
-            messagebox.showinfo("Success", "Zero TAR command sent to Arduino.")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to send Zero TAR command: {e}")
+        # Kirim "T" lewat koneksi serial bersama, tunggu balasan "Berat dinolkan!"
+        def done(reply, error):
+            if error:
+                messagebox.showerror("Error", f"Failed to send Zero TAR command: {error}")
+            else:
+                self.controller.link.tare()
+                messagebox.showinfo("Success", "Zero TAR command sent to Arduino.")
+        self.controller.run_command("T", r"Berat dinolkan", done)
     #
     # def send_calibration_values(self):
     #     # Validate inputs for integers
@@ -956,47 +3218,117 @@ class CalibrationPage(ctk.CTkFrame):
             messagebox.showerror("Validation Error", "Please enter angka untuk Set Value Calibration.")
             return
 
-        # Format data sesuai instruksi: misal "C240"
+        # Format data sesuai instruksi: misal "C240", newline mengakhiri angka di firmware
         data_str = f"C{set_low}"
 
-        # Kirim ke serial port
-        try:
-            import serial  # pastikan pyserial sudah di-import
-            ser = serial.Serial(COM_PORT, BAUDRATE, timeout=1)
-            ser.write(data_str.encode('ascii'))  # encode string ke bytes
-            ser.close()
-            messagebox.showinfo("Success", f"Calibration command sent to Arduino: \"{data_str}\"")
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to send Calibration command: {e}")
+        def done(reply, error):
+            if error:
+                messagebox.showerror("Error", f"Failed to send Calibration command: {error}")
+            elif reply.startswith("Input tidak valid"):
+                messagebox.showerror("Error", f"Arduino rejected calibration value: {reply}")
+            else:
+                messagebox.showinfo("Success", f"Calibration command sent to Arduino: \"{data_str}\"")
+        self.controller.run_command(data_str + "\n", r"Faktor kalibrasi|Input tidak valid", done)
 
     def start_serial_calibration(self):
-        # Hentikan thread sebelumnya jika ada
+        # Hentikan langganan sebelumnya jika ada
         self.stop_serial_calibration()
-        self.calib_serial_stop_event.clear()
-        # Gunakan SerialReader yang sudah ada, atau buat baru jika perlu
-        self.calib_serial_thread = SerialReader(COM_PORT, BAUDRATE, self.calib_data_queue, self.calib_serial_stop_event)
-        self.calib_serial_thread.start()
+        self.calib_data_queue = queue.Queue()
+        self.controller.link.subscribe(self.calib_data_queue)
+        self.calib_streaming = True
         self.after(100, self.update_calibration_data)
 
     def stop_serial_calibration(self):
-        if self.calib_serial_thread:
-            self.calib_serial_stop_event.set()
-            self.calib_serial_thread = None
+        if self.capture_grams is not None:
+            self.end_capture()
+        self.controller.link.unsubscribe(self.calib_data_queue)
+        self.calib_streaming = False
 
     def update_calibration_data(self):
         # Ambil data dari queue dan update label
         while not self.calib_data_queue.empty():
-            val = self.calib_data_queue.get()
-            if val and len(val) == 2 and val[0] != 'error':
-                flow, volume = val
+            kind, val = self.calib_data_queue.get()
+            if kind == 'samples':
+                _, flow, volume, _ = val[-1]
                 tar = 0.0  # Jika ada data TAR dari serial, ambil di sini
                 self.update_labels(flow, volume, tar)
-            elif val and val[0] == 'error':
-                messagebox.showerror("Serial Error", f"Failed to open serial port: {val[1]}")
+                if self.capture_grams is not None:
+                    self.add_capture(val[:, 3])
+            elif kind == 'error':
+                messagebox.showerror("Serial Error", f"Failed to open serial port: {val}")
                 self.stop_serial_calibration()
-        if self.calib_serial_thread and not self.calib_serial_stop_event.is_set():
+        if self.calib_streaming:
             self.after(100, self.update_calibration_data)
 
+    def capture_point(self):
+        try:
+            grams = float(self.entry_reference.get())
+        except ValueError:
+            messagebox.showerror("Validation Error", "Enter the reference weight in grams.")
+            return
+        if not self.calib_streaming:
+            self.start_serial_calibration()
+        self.capture_grams = grams
+        self.capture_raws = []
+        self.capture_job = self.after(int(CALIBRATION_CAPTURE_TIMEOUT_S * 1000), self.capture_timed_out)
+        self.btn_capture.configure(state="disabled", text="Capturing...")
+
+    def end_capture(self):
+        # Back to idle, whether the capture finished, timed out or was cancelled
+        if self.capture_job is not None:
+            self.after_cancel(self.capture_job)
+            self.capture_job = None
+        self.capture_grams = None
+        self.btn_capture.configure(state="normal", text="Capture")
+
+    def capture_timed_out(self):
+        self.capture_job = None
+        self.end_capture()
+        messagebox.showerror("Calibration", "No readings arrived from the device. Check the connection and capture again.")
+
+    def add_capture(self, raws):
+        # The point is the median of CALIBRATION_CAPTURE_SAMPLES readings, so
+        # a knock on the scale while capturing does not move it
+        self.capture_raws.append(raws)
+        raws = np.concatenate(self.capture_raws)
+        if len(raws) < CALIBRATION_CAPTURE_SAMPLES:
+            return
+        grams = self.capture_grams
+        self.end_capture()
+        raws = raws[~np.isnan(raws)]
+        if not len(raws):
+            messagebox.showerror("Error", "The device sends no raw counts; multi-point calibration needs the v5 firmware.")
+            return
+        self.points.append([float(np.median(raws)), grams])
+        self.show_points()
+
+    def show_points(self):
+        if not self.points:
+            self.lbl_points.configure(text="No points captured")
+            return
+        self.lbl_points.configure(text="\n".join(f"{grams:8.1f} g   {raw:12.0f} counts" for raw, grams in self.points))
+
+    def clear_points(self):
+        # Also cancels a capture in progress
+        if self.capture_grams is not None:
+            self.end_capture()
+        self.points = []
+        self.show_points()
+
+    def save_profile(self):
+        device = self.controller.link.device
+        if device is None:
+            messagebox.showerror("Error", "Connect the device before saving its calibration.")
+            return
+        try:
+            _, residual = save_calibration(device, self.points, CALIBRATION_DEGREES[self.option_degree.get()])
+        except ValueError as e:
+            messagebox.showerror("Calibration", str(e))
+            return
+        self.controller.link.recalibrate()
+        messagebox.showinfo("Calibration", f"Calibration saved for {device} from {len(self.points)} points "
+                                           f"(RMS error {residual:.2f} g).")
+
 class SettingPage(ctk.CTkFrame):
 
     def __init__(self, parent, controller):
@@ -1075,11 +3407,7 @@ class SettingPage(ctk.CTkFrame):
         name = self.hosp_name.get().strip()
         address = self.hosp_addr.get().strip()
         if name and address:
-            conn = sqlite3.connect('hospital_doctor.db')
-            c = conn.cursor()
-            c.execute("INSERT INTO hospitals (name, address) VALUES (?, ?)", (name, address))
-            conn.commit()
-            conn.close()
+            db.execute("INSERT INTO hospitals (name, address) VALUES (?, ?)", (name, address))
             self.refresh_hospital()
             self.hosp_name.delete(0, "end")
             self.hosp_addr.delete(0, "end")
@@ -1088,24 +3416,17 @@ class SettingPage(ctk.CTkFrame):
         selected = self.hosp_table.selection()
         if selected:
             idx = self.hosp_table.index(selected[0])
-            conn = sqlite3.connect('hospital_doctor.db')
-            c = conn.cursor()
-            c.execute("SELECT id FROM hospitals ORDER BY id")
-            ids = [row[0] for row in c.fetchall()]
-            if idx < len(ids):
-                c.execute("DELETE FROM hospitals WHERE id=?", (ids[idx],))
-                conn.commit()
-            conn.close()
+            with db.transaction() as c:
+                row = c.execute("SELECT id FROM hospitals WHERE active=1 ORDER BY id LIMIT 1 OFFSET ?", (idx,)).fetchone()
+                if row:
+                    # Patients still reference it, so it is only hidden
+                    c.execute("UPDATE hospitals SET active=0 WHERE id=?", row)
             self.refresh_hospital()
 
     def refresh_hospital(self):
         for item in self.hosp_table.get_children():
             self.hosp_table.delete(item)
-        conn = sqlite3.connect('hospital_doctor.db')
-        c = conn.cursor()
-        c.execute("SELECT name, address FROM hospitals ORDER BY id")
-        rows = c.fetchall()
-        conn.close()
+        rows = db.query("SELECT name, address FROM hospitals WHERE active=1 ORDER BY id")
         for idx, (hosp, addr) in enumerate(rows, start=1):
             self.hosp_table.insert("", "end", values=(idx, hosp, addr))
 
@@ -1115,11 +3436,7 @@ class SettingPage(ctk.CTkFrame):
             self.controller.on_close()
             return
         if name:
-            conn = sqlite3.connect('hospital_doctor.db')
-            c = conn.cursor()
-            c.execute("INSERT INTO doctors (name) VALUES (?)", (name,))
-            conn.commit()
-            conn.close()
+            db.execute("INSERT INTO doctors (name) VALUES (?)", (name,))
             self.refresh_doctor()
             self.doc_name.delete(0, "end")
 
@@ -1127,28 +3444,75 @@ class SettingPage(ctk.CTkFrame):
         selected = self.doc_table.selection()
         if selected:
             idx = self.doc_table.index(selected[0])
-            conn = sqlite3.connect('hospital_doctor.db')
-            c = conn.cursor()
-            c.execute("SELECT id FROM doctors ORDER BY id")
-            ids = [row[0] for row in c.fetchall()]
-            if idx < len(ids):
-                c.execute("DELETE FROM doctors WHERE id=?", (ids[idx],))
-                conn.commit()
-            conn.close()
+            with db.transaction() as c:
+                row = c.execute("SELECT id FROM doctors WHERE active=1 ORDER BY id LIMIT 1 OFFSET ?", (idx,)).fetchone()
+                if row:
+                    c.execute("UPDATE doctors SET active=0 WHERE id=?", row)
             self.refresh_doctor()
 
     def refresh_doctor(self):
         for item in self.doc_table.get_children():
             self.doc_table.delete(item)
-        conn = sqlite3.connect('hospital_doctor.db')
-        c = conn.cursor()
-        c.execute("SELECT name FROM doctors ORDER BY id")
-        rows = c.fetchall()
-        conn.close()
+        rows = db.query("SELECT name FROM doctors WHERE active=1 ORDER BY id")
         for idx, (doc,) in enumerate(rows, start=1):
             self.doc_table.insert("", "end", values=(idx, doc))
 
+def export_command(argv):
+    # python UROSON_V1.4.py export [--from D] [--to D] [--hospital NAME] [--doctor NAME] [--combined] OUTPUT
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="UROSON_V1.4.py export", description="Batch export patient reports")
+    parser.add_argument("output", help="directory for individual PDFs, or the PDF file with --combined")
+    parser.add_argument("--from", dest="date_from", help="first date, yyyy-mm-dd")
+    parser.add_argument("--to", dest="date_to", help="last date, yyyy-mm-dd")
+    parser.add_argument("--hospital", help="hospital name")
+    parser.add_argument("--doctor", help="doctor name")
+    parser.add_argument("--combined", action="store_true", help="write one combined PDF")
+    parser.add_argument("--workers", type=int, default=REPORT_WORKERS)
+    args = parser.parse_args(argv)
+
+    setup_database()
+    hospital_id = doctor_id = None
+    if args.hospital:
+        row = db.query_one("SELECT id FROM hospitals WHERE name=? ORDER BY active DESC, id", (args.hospital,))
+        if row is None:
+            parser.error(f"unknown hospital {args.hospital!r}")
+        hospital_id = row[0]
+    if args.doctor:
+        row = db.query_one("SELECT id FROM doctors WHERE name=? ORDER BY active DESC, id", (args.doctor,))
+        if row is None:
+            parser.error(f"unknown doctor {args.doctor!r}")
+        doctor_id = row[0]
+
+    row_ids = batch_row_ids(args.date_from, args.date_to, hospital_id, doctor_id)
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(args.workers, mp_context=ctx) as executor:
+        count, seconds = export_reports(executor, row_ids, args.output, args.combined,
+                                        lambda done, total: print(f"\r{done}/{total}", end="", flush=True))
+    print(f"\nExported {count} reports in {seconds:.1f} s ({count / max(seconds, 1e-9):.1f} reports/s)")
+    db.close()
+
+def benchmark_command(argv):
+    # python UROSON_V1.4.py benchmark [--samples N] [--block N ...]
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="UROSON_V1.4.py benchmark", description="Measure host filter throughput")
+    parser.add_argument("--samples", type=int, default=200000)
+    parser.add_argument("--block", type=int, nargs="+", default=[1, 16, 256, 4096], help="rows per streamed block")
+    args = parser.parse_args(argv)
+
+    for name in ("savgol", "butterworth"):
+        config = HOST_FILTER._replace(differentiator=name)
+        for block_size in args.block:
+            streaming, offline = benchmark_filter(config, args.samples, block_size)
+            print(f"{name:12} block {block_size:5}: streaming {streaming:12,.0f} samples/s, offline {offline:12,.0f} samples/s")
+
 if __name__ == "__main__":
-    app = App()
-    app.mainloop()
+    if sys.argv[1:2] == ["export"]:
+        export_command(sys.argv[2:])
+    elif sys.argv[1:2] == ["benchmark"]:
+        benchmark_command(sys.argv[2:])
+    else:
+        app = App()
+        app.mainloop()
 